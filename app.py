@@ -1,57 +1,72 @@
-from tree import KDTree
+from tree import KDTree, QueryCache
+from tree_cache import TreeCache
+import os
+import json
+import base64
+import hashlib
 import numpy as np
 import plotly.graph_objects as go
 import dash_bootstrap_components as dbc
 from plotly.subplots import make_subplots
-from dash import Dash, dcc, html, Input, Output, State, ClientsideFunction, callback
-from flask_caching import Cache
+from concurrent.futures import ProcessPoolExecutor
+from dash import Dash, dcc, html, Input, Output, State, ClientsideFunction, no_update
 
-# The following commented out code is the python implemtnation of the ClientsideFunction, 
-# it will only work if there is a dash server, which means it does not work in a static website
+# Number of worker processes that answer the sphere queries on the server, 0 (the default) leaves them to the
+# clientside callback in assets/clientside.js instead, which is the only option for a static website
+SPHERE_WORKERS = int(os.environ.get("SPHERE_WORKERS", "0"))
 
-""" @callback(
-    Output("sphere_neighbors_out", "children"),
-    Output("kd-tree-sphere", "figure"),
-    Input("kd-tree-sphere", "figure"),
-    Input("traverse-button", "n_clicks"),
-    State("a_val", "value"),
-    State("b_val", "value"),
-    State("c_val", "value"),
-    State("r_val", "value"),
-    
-)
-def find_sphere_neighbors(fig, clicks, a, b, c, r):
+# Past this many levels and points the figure only shows the top of the tree and a sample of its points,
+# so it stays the same size however big the tree gets (see KDTree.draw)
+FIGURE_MAX_DEPTH = 10
+FIGURE_MAX_POINTS = 20000
+
+# Bump this whenever the drawing code changes, so the figures kept in TREE_CACHE_DIR by older code aren't used anymore
+FIGURE_FORMAT = 1
 
-# Since this function is in a callback in dash, the KD Tree is in the flask cache for quick access
-    tree = cache.get('kdtree')
-# Empty until Found :)
+# The pool of workers, only started by the app when SPHERE_WORKERS is set
+pool = None
+
+# What each worker process loads once (see init_worker): the memory mapped snapshot of the tree shared by
+# every worker, the figure of the tree and the frames of the last animations it made
+worker = {}
+
+# The following code is the python implementation of the ClientsideFunction,
+# it will only work if there is a dash server, which means it does not work in a static website
+
+def find_sphere_neighbors(clicks, a, b, c, r):
+# The search and the animation run in one of the workers, which only takes the CPU work off this process's GIL:
+# the flask thread of this request still waits for the worker to finish, while the other requests are answered
+# by their own threads (and workers) in the meantime. The app's figure is only copied to add the results to it
     found = False
     results = []
     ret = ""
+    figure = fig
 # Checks if the user has started the traverse or not:
     if clicks > 0 and (a and b and c and r):
     #Assume there's none until proven otherwise
         ret = "There are no neighbors in this sphere!"
-        results, found, coordinates, inorder_neighbors = tree.find_sphere_neighbors(a,b,c,r)
-
-    # Time to Animate Traversal! YAYYYYYYYYYYY
-        frames = traversal_animation(coordinates,inorder_neighbors)
-
-    #Plots the sphere and hide the barriers from the graph
-        fig = plot_sphere(a, b, c, r)
-
-        fig.frames = frames
-        fig.update_layout( 
-            scene=dict( 
-                xaxis=dict(showspikes=False), 
-                yaxis=dict(showspikes=False), 
-                zaxis=dict(showspikes=False), 
-            ), 
-            updatemenus=[ { 
+        try:
+            results, found, traces, frames = pool.submit(sphere_query, a, b, c, r).result()
+        except Exception as error:
+        # A failed query (or a worker that could not open the tree) leaves the figure as it is
+            return dbc.Alert(f"The neighbors could not be computed: {error}", color = "danger"), no_update
+
+    #Plots the sphere, hides the barriers from the graph and adds the animation of the traversal
+        figure = plot_sphere(fig, a, b, c, r, traces)
+        figure["frames"] = frames
+        figure["layout"] = {
+            **figure["layout"],
+            "scene": {
+                **figure["layout"].get("scene", {}),
+                "xaxis": {"showspikes": False},
+                "yaxis": {"showspikes": False},
+                "zaxis": {"showspikes": False},
+            },
+            "updatemenus": [ {
                 "buttons": [ { "args": [None, {"frame": {"duration": 1250, "redraw": True}, "fromcurrent": True}], "label": "Traverse Tree", "method": "animate" },
-            {"args": [[None], {"frame": {"duration": 0, "redraw": True}, "mode": "immediate", "transition": {"duration": 0}}], "label": "Pause Traversal", "method": "animate" 
+            {"args": [[None], {"frame": {"duration": 0, "redraw": True}, "mode": "immediate", "transition": {"duration": 0}}], "label": "Pause Traversal", "method": "animate"
              }],
-        "direction": "left", "pad": {"r": 10, "t": 20},"showactive": False, "type": "buttons", "x": 0.1, "xanchor": "right", "y": 0, "yanchor": "top" } ] )
+        "direction": "left", "pad": {"r": 10, "t": 20},"showactive": False, "type": "buttons", "x": 0.1, "xanchor": "right", "y": 0, "yanchor": "top" } ] }
     # Create a string so that the results look nicer
         neighbs = ", ".join([str(result) for result in results])
 
@@ -66,14 +81,57 @@ def find_sphere_neighbors(fig, clicks, a, b, c, r):
     else:
         alert = dbc.Alert("Please enter all coordinates and the radius...", color = "warning")
 
-    return alert, fig
-
-def plot_sphere(a, b, c, r):
-# Remove the barriers, and create the sphere :)
-    fig.update_traces(visible = False, selector= dict(type = 'surface'))
-    sphere = create_sphere(a,b,c,r)
-    fig.add_trace(sphere)
-    return fig
+    return alert, figure
+
+def init_worker(directory, tree_name):
+# Runs once in every worker process, the snapshots were already made by the app so nothing is built here
+    cache = TreeCache(directory)
+    tree = cache.get(tree_name)
+    figure = cache.figure(tree_name)
+    if tree is None or figure is None:
+    # Raising here would only break the pool, every query reports it instead
+        worker.update(error = f"There is no snapshot of the tree {tree_name!r} in {directory}")
+        return
+    tree.query_cache = QueryCache()
+    worker.update(tree = tree, figure = figure, frames = QueryCache())
+
+def sphere_query(a, b, c, r):
+    """
+    Searches the sphere in the tree of this worker and makes the frames of its traversal, both are kept
+    in the worker's query caches so asking for the same sphere again is answered right away
+
+    Args:
+        a (float): x-coordinate of the center of the sphere
+        b (float): y-coordinate of the center of the sphere
+        c (float): z-coordinate of the center of the sphere
+        r (float): radius of the sphere
+
+    Returns:
+        results (list): all the neighbors in the sphere, sorted
+        found (bool): True if the center of the sphere is in the tree, False otherwise
+        traces (list): the traces the animation changes, which go right after the traces of the figure
+        frames (list): the frames of the traversal animation
+    """
+    if "error" in worker:
+        raise FileNotFoundError(worker["error"])
+    tree = worker["tree"]
+    results, found, coordinates, inorder_neighbors = tree.find_sphere_neighbors(a,b,c,r, trace = True)
+    traces, frames = worker["frames"].get_or_compute(
+        (tree.version, a, b, c, r),
+        lambda: traversal_animation(worker["figure"], coordinates, inorder_neighbors)
+    )
+    return results, found, traces, frames
+
+def plot_sphere(fig, a, b, c, r, traces = ()):
+# Remove the barriers, add the traces of the animation right after the figure's own ones, and create the sphere :)
+    figure = dict(fig)
+    figure["data"] = [
+        {**trace, "visible": False} if trace.get("type") in ("mesh3d", "surface") else trace
+        for trace in fig["data"]
+    ]
+    figure["data"].extend(traces)
+    figure["data"].append(create_sphere(a,b,c,r).to_plotly_json())
+    return figure
 
 def create_sphere(a, b, c, r):
 
@@ -105,9 +163,44 @@ def create_sphere(a, b, c, r):
                                   "z.highlight": False})
     return sphere
 
-def traversal_animation(coors,neighbs):
-    scatter_list = [trace.to_plotly_json() for trace in fig.data if isinstance(trace, go.Scatter)]
-    surface_list = [trace.to_plotly_json() for trace in fig.data if isinstance(trace, go.Surface)]
+def plotly_array(value):
+# Figures written by newer versions of plotly keep NumPy arrays as {"dtype", "bdata", "shape"}
+    if isinstance(value, dict) and "bdata" in value:
+        array = np.frombuffer(base64.b64decode(value["bdata"]), dtype = value["dtype"])
+        return array.reshape(value["shape"]) if "shape" in value else array
+    return np.asarray(value)
+
+def traversal_animation(fig, coors, neighbs):
+    """
+    Makes the frames of the traversal animation, the same ones createTraversalAnimation in assets/clientside.js makes.
+    A frame only carries the traces that change, addressed by their index with `traces`, so the animation grows
+    with the number of visited nodes instead of the size of the tree: markers on top of the visited nodes of the
+    2D Representation with their colors in one list, and the grey plane of the node being visited.
+    Those two traces are returned with the frames, and have to go right after the traces of fig
+
+    Args:
+        fig (dict): the figure of the tree (see make_figure) as a plotly figure dictionary
+        coors (list): the 2D and 3D coordinates of every node the search visited (see KDTree.find_sphere_neighbors)
+        neighbs (list): the 2D coordinate of the neighbor found by each visit (None when it found none),
+        after a None for before the first visit
+
+    Returns:
+        traces (list): the traversal markers and the plane, as plotly trace dictionaries
+        frames (list): the frames, as plotly frame dictionaries
+    """
+    traversal_index = len(fig["data"])
+    barrier_index = traversal_index + 1
+    markers = next((trace for trace in fig["data"] if trace["type"] == "scatter" and trace.get("hoverinfo") == "text"), {})
+
+# The barriers of a level are one mesh with four corners per barrier (see barrier_meshes), and the mesh's meta
+# has the name "(x, y, z)" of every barrier's node
+    barrier_dict = {}
+    for mesh in fig["data"]:
+        if mesh["type"] == "mesh3d":
+            corners = [plotly_array(mesh[axis]) for axis in ("x", "y", "z")]
+            for b, name in enumerate(mesh.get("meta", [])):
+                coordinate = tuple(float(value) for value in name[1:-1].split(", "))
+                barrier_dict[coordinate] = (corners, 4 * b)
 
     checking_node_color = 'orange'
     neighboring_node_color = 'green'
@@ -116,92 +209,120 @@ def traversal_animation(coors,neighbs):
     # Create a list of frames for the animation
     frames = []
 
-    # Create a dictionary to map the coordinates with the traces
-    trace_dict = {}
-    for trace in scatter_list:
-        if trace['hoverinfo'] == 'text':
-            coordinate = (trace['x'][0], trace['y'][0])
-            trace_dict[coordinate] = trace
+    # Every visited node gets one marker, in the order they are first visited, and they all start black
+    marker_dict = {}
+    for tree_coor, graph_coor in coors:
+        marker_dict.setdefault(tuple(tree_coor), len(marker_dict))
+    colors = ['black'] * len(marker_dict)
+
+    traces = [
+        dict(
+            type = 'scatter',
+            x = [coordinate[0] for coordinate in marker_dict],
+            y = [coordinate[1] for coordinate in marker_dict],
+            mode = 'markers',
+            marker = {**markers.get("marker", {}), "color": colors.copy()},
+            xaxis = markers.get("xaxis"),
+            yaxis = markers.get("yaxis"),
+            hoverinfo = 'skip',
+            showlegend = False,
+            name = 'traversal'
+        ),
+        dict(
+            type = 'mesh3d',
+            x = [],
+            y = [],
+            z = [],
+            i = [0, 0],
+            j = [1, 2],
+            k = [2, 3],
+            color = 'grey',
+            opacity = 1,
+            hoverinfo = 'skip',
+            name = 'current barrier'
+        )
+    ]
 
-    seen_neighbors = set()
+    neighbor_nodes = set()
+    checked_nodes = set()
+    previous_coor = None
 
-    points_list = [trace.to_plotly_json() for trace in fig.data if trace['type'] == 'scatter3d']
-    scatter_list.extend(points_list)
-    
-    for i in range(len(coors)):
-        updated_data = scatter_list.copy()
+    for i in range(len(neighbs)):
+        # The last frame shows the last visited node again, with its final color
+        is_last_frame = i == len(neighbs) - 1
+        coors_index = len(coors) - 1 if is_last_frame else i
         # Calculate ax based on the position in the tree
-        if i == 0:
+        if coors_index == 0:
             ax, ay = 0, 75  # Root
-        elif i % 2 == 0:
+        elif coors_index % 2 == 0:
             ax, ay = -50, -40  # Left
         else:
             ax, ay = 50, -40  # Right
-        
-        tree_coor = coors[i][0]
-        graph_coor = coors[i][1]
-
-        plane = None
-        for surface in surface_list:
-            if surface['name'] == str(graph_coor):
-                surface['colorscale'] = "gray"
-                surface['opacity'] = 1
-                plane = surface
-                print(surface)
-
-        updated_data.append(plane)
-
-        # Update the color of the corresponding trace
-        if tree_coor in trace_dict:
-            trace_dict[tree_coor]['marker']['color'] = checking_node_color
-
-        if neighbs[i]:
-            coord = neighbs[i]
-            if coord in trace_dict:
-                trace_dict[coord]['marker']['color'] = neighboring_node_color
-                seen_neighbors.add(coord)
-
-        for coord, trace in trace_dict.items():
-            if coord != tree_coor and trace['marker']['color'] == checking_node_color:
-                trace_dict[coord]['marker']['color'] = stranger_node_color
-
-        # Create a frame with the updated trace and the arrow annotation
-        frame = go.Frame(
-            data=updated_data,
-            layout=go.Layout(
-                annotations=[
-                    go.layout.Annotation(
-                        x=tree_coor[0],
-                        y=tree_coor[1],
-                        ax=ax,
-                        ay=ay,
-                        xref="x",
-                        yref="y",
-                        text="Current Node",
-                        showarrow=True,
-                        font=dict(size=16, color="#ff0000"),
-                        arrowhead=2,
-                        arrowsize=1,
-                        arrowwidth=3,
-                        arrowcolor="#ff0000",
-                        opacity=0.8
+
+        tree_coor = tuple(coors[coors_index][0])
+        graph_coor = tuple(coors[coors_index][1])
+
+        # Move the grey plane to the barrier of the node that is visited, or hide it if the node has none
+        plane = dict(visible = False)
+        barrier = barrier_dict.get(tuple(float(value) for value in graph_coor))
+        if barrier:
+            (xs, ys, zs), first = barrier
+            plane = dict(
+                x = xs[first:first + 4].tolist(),
+                y = ys[first:first + 4].tolist(),
+                z = zs[first:first + 4].tolist(),
+                visible = True,
+                name = str(graph_coor)
+            )
+
+        # Only the node being visited, the neighbor found by the last visit and the node visited before can change color
+        neighbor_coor = tuple(neighbs[i]) if neighbs[i] else None
+        for coordinate in {tree_coor, neighbor_coor, previous_coor}:
+            k = marker_dict.get(coordinate)
+            if k is None:
+                continue
+            if coordinate == tree_coor and not is_last_frame:
+                colors[k] = checking_node_color
+                checked_nodes.add(coordinate)
+            elif coordinate in neighbor_nodes:
+                colors[k] = neighboring_node_color
+            elif coordinate == neighbor_coor:
+                colors[k] = neighboring_node_color
+                neighbor_nodes.add(coordinate)
+            elif coordinate in checked_nodes:
+                colors[k] = stranger_node_color
+            else:
+                colors[k] = 'black'
+        previous_coor = tree_coor
+
+        # Create a frame with the updated traces and the arrow annotation
+        frames.append(dict(
+            data = [dict(marker = dict(color = colors.copy())), plane],
+            traces = [traversal_index, barrier_index],
+            layout = dict(
+                annotations = [
+                    dict(
+                        x = tree_coor[0],
+                        y = tree_coor[1],
+                        ax = ax,
+                        ay = ay,
+                        xref = "x",
+                        yref = "y",
+                        text = "Current Node",
+                        showarrow = True,
+                        font = dict(size = 16, color = "#ff0000"),
+                        arrowhead = 2,
+                        arrowsize = 1,
+                        arrowwidth = 3,
+                        arrowcolor = "#ff0000",
+                        opacity = 0.8
                     )
                 ]
             ),
-            name=f'frame{i}'
-        )
-        frames.append(frame)
-
-    # Check Final Value:
-    if tree_coor == neighbs[-1]:
-        trace_dict[tree_coor]['marker']['color'] = neighboring_node_color
-    else:
-        trace_dict[tree_coor]['marker']['color'] = stranger_node_color
-        frames.append(go.Frame(data=updated_data, layout=go.Layout(annotations=[]), name='final'))
-
-    return frames """
-
+            name = 'final' if i == len(coors) - 1 else f'frame{i}'
+        ))
 
+    return traces, frames
 
 def make_tree():
 # Creates a tree
@@ -221,25 +342,8 @@ def make_tree():
     tree.add(75,100,90)
     return tree
 
-if __name__ == "__main__":
-#TODO: Maybe not have it pre-determined for the user, possibly add the ability to put stuff, but it could also just make it hard...
-    #Note for the TODO, this is possible however the rest of the KDTree and KDNode structure will have to be transpiled into Javascript
-    #After that having the tree dynamically made in javascript will minimize "headaches" like this...
-    tree = make_tree()
-
-# Initialize the Dash app with the Bootstrap Theme :O
-    app = Dash(external_stylesheets=[dbc.themes.COSMO])
-    app.title = '3D KD Tree Demo'
-
-#Cache the KD Tree into memory for the spherical calculations :)
-    cache = Cache(app.server, config = { 
-        'CACHE_TYPE': 'simple'
-    })
-    cache.set('kdtree', tree)
-
+def make_figure(tree):
 # Figures for plotly
-    fig = go.Figure()
-
     fig = make_subplots(
         rows = 1,
         cols = 2,
@@ -249,7 +353,7 @@ if __name__ == "__main__":
     )
 
 # Get the Figure from the Tree
-    fig = tree.draw(fig)
+    fig = tree.draw(fig, max_depth = FIGURE_MAX_DEPTH, max_points = FIGURE_MAX_POINTS)
 
 # Make it Pretty through removing legend for traces on the 2D KD Representation and reducing margins so you see more of the graph 
     fig.update_layout(showlegend = False,
@@ -257,6 +361,35 @@ if __name__ == "__main__":
     )
     fig.update_xaxes(showticklabels = False, row = 1, col = 1)
     fig.update_yaxes(showticklabels = False, row = 1, col = 1)
+    return fig
+
+def tree_key(tree):
+# Short hash of the tree's content and of how its figure is drawn, which its snapshot and figure are cached under
+    content = json.dumps([tree.to_flat_dict(), FIGURE_FORMAT, FIGURE_MAX_DEPTH, FIGURE_MAX_POINTS], sort_keys = True)
+    return hashlib.sha1(content.encode()).hexdigest()[:12]
+
+def asset_version(path):
+# Short hash of the file, the clientside callback keeps its parsed tree until this changes
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+if __name__ == "__main__":
+#TODO: Maybe not have it pre-determined for the user, possibly add the ability to put stuff, but it could also just make it hard...
+    #Note for the TODO, this is possible however the rest of the KDTree and KDNode structure will have to be transpiled into Javascript
+    #After that having the tree dynamically made in javascript will minimize "headaches" like this...
+
+# Initialize the Dash app with the Bootstrap Theme :O
+    app = Dash(external_stylesheets=[dbc.themes.COSMO])
+    app.title = '3D KD Tree Demo'
+
+#Cache the KD Tree and its figure for the spherical calculations :)
+    #Every worker shares the snapshots in TREE_CACHE_DIR, the name follows the tree's content and how its figure is drawn,
+    #so a changed make_tree or figure gets a new snapshot instead of the old one being served
+    cache = TreeCache(os.environ.get("TREE_CACHE_DIR", "tree_cache"))
+    demo_tree = make_tree()
+    tree_name = "demo-" + tree_key(demo_tree)
+    cache.get(tree_name, lambda: demo_tree)
+    fig = cache.figure(tree_name, lambda: make_figure(demo_tree))
     
 # All of the dbc.Cards are just the HTML Content using Bootstrap
     intro_content = dbc.Card(
@@ -512,6 +645,7 @@ if __name__ == "__main__":
     )
     # Define the dash app layout
     app.layout = html.Div([
+        dcc.Store(id = "tree-version", data = asset_version("assets/tree_data.json")),
         html.H1(dcc.Markdown('3D KD Tree by [Eugene Thompson](https://github.com/euhystho)'), className = 'custom-link', style = {'textAlign': 'center'}),
         dbc.Tabs(
             [
@@ -523,20 +657,34 @@ if __name__ == "__main__":
         ),
     ])
 
-# Javascript Clientside Callback :)
-    app.clientside_callback(
-        ClientsideFunction(
-            namespace='clientside',
-            function_name='findSphereNeighbors'
-        ),
-        Output("kd-tree-sphere", "figure"),
-        Input("kd-tree-sphere", "figure"),
-        Input("traverse-button", "n_clicks"),
-        State("a_val", "value"),
-        State("b_val", "value"),
-        State("c_val", "value"),
-        State("r_val", "value"),
-    )
+# With SPHERE_WORKERS set the spheres are searched on the server, by a pool of workers that all share the snapshot
+    if SPHERE_WORKERS > 0:
+        pool = ProcessPoolExecutor(SPHERE_WORKERS, initializer = init_worker, initargs = (cache.directory, tree_name))
+        app.callback(
+            Output("sphere_neighbors_out", "children"),
+            Output("kd-tree-sphere", "figure"),
+            Input("traverse-button", "n_clicks"),
+            State("a_val", "value"),
+            State("b_val", "value"),
+            State("c_val", "value"),
+            State("r_val", "value"),
+        )(find_sphere_neighbors)
+    else:
+    # Javascript Clientside Callback :)
+        app.clientside_callback(
+            ClientsideFunction(
+                namespace='clientside',
+                function_name='findSphereNeighbors'
+            ),
+            Output("kd-tree-sphere", "figure"),
+            Input("kd-tree-sphere", "figure"),
+            Input("traverse-button", "n_clicks"),
+            State("a_val", "value"),
+            State("b_val", "value"),
+            State("c_val", "value"),
+            State("r_val", "value"),
+            State("tree-version", "data"),
+        )
 # Run the app :D, feel free to toggle the debug,
 # if the debug is set to True then any changes in the python code or javascript code will reflect
 # if you save it and the website will reload (very helpful for web dev)
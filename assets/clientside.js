@@ -2,30 +2,78 @@
 window.dash_clientside = window.dash_clientside || {};
 window.dash_clientside.clientside = window.dash_clientside.clientside || {};
 
-window.dash_clientside.clientside.findSphereNeighbors = function(fig, clicks, a, b, c, r) {
+// The tree is fetched and parsed once per page, and only fetched again when the version from the app changes
+let cachedTree = {version: null, promise: null};
+
+function getTree(version) {
+    if (!cachedTree.promise || cachedTree.version !== version) {
+    // The version in the url also keeps the browser from answering with a stale copy of the file
+        const url = version ? `/assets/tree_data.json?v=${version}` : '/assets/tree_data.json';
+        const entry = {
+            version: version,
+        //Build the javascript version of the tree from either the flat columns or the nested tree_structure
+            promise: fetch(url).then(response => response.json()).then(loadTree)
+        };
+    // A failed fetch is forgotten so the next click tries again
+        entry.promise.catch(() => {
+            if (cachedTree === entry) {
+                cachedTree = {version: null, promise: null};
+            }
+        });
+        cachedTree = entry;
+    }
+    return cachedTree.promise;
+}
+
+// The results and animation frames of the last spheres, keyed by the version of the tree and the sphere,
+// so clicking the button again for the same sphere doesn't search the tree and build the frames again
+const QUERY_CACHE_SIZE = 32;
+const queryCache = new Map();
+
+// Names of the traces a click adds to the figure, which the next click replaces
+const ANIMATION_TRACES = ['traversal', 'current barrier', 'sphere'];
+
+function cachedQuery(tree, fig, a, b, c, r, version) {
+    const key = `${version}|${a}|${b}|${c}|${r}`;
+    let entry = queryCache.get(key);
+    if (entry) {
+    // A Map keeps insertion order, so putting the entry back at the end makes it the most recently used one
+        queryCache.delete(key);
+    } else {
+        const [results, found, coordinates, inorderNeighbors] = tree.findSphereNeighbors(a,b,c,r,true);
+        entry = {results, found, animation: createTraversalAnimation(fig, coordinates, inorderNeighbors)};
+        if (queryCache.size >= QUERY_CACHE_SIZE) {
+            queryCache.delete(queryCache.keys().next().value);
+        }
+    }
+    queryCache.set(key, entry);
+    return entry;
+}
+
+window.dash_clientside.clientside.findSphereNeighbors = function(fig, clicks, a, b, c, r, version) {
 // Check if the user has put values and clicked the button
     if (clicks > 0 && a && b && c && r){
-    // Start by getting the tree json
-        return fetch('/assets/tree_data.json')
-            .then(response => response.json())
-        //Extract the tree_structure to make it work with the javascript version of the python script
-            .then(tree_structure => {
-                const tree = new KDTree(tree_structure);
-                let [results, found, coordinates, inorderNeighbors] = tree.findSphereNeighbors(a,b,c,r);
-
-            // Create a deep copy of the plotly figure 
-                let updatedFig = JSON.parse(JSON.stringify(fig));
-
-            // Generates frames for the tree traversal
-                updatedFig.frames = createTraversalAnimation(fig, coordinates, inorderNeighbors);
-
-            // Remove all existing surface traces
-                updatedFig.data = updatedFig.data.map(trace => {
-                    if (trace.type === 'surface') {
-                        return {...trace, visible: false};
-                    }
-                    return trace;
-                });
+    // Start by getting the (cached) tree
+        return getTree(version)
+            .then(tree => {
+            // Only the traces and layout that change are copied, everything else is shared with the old figure
+                let updatedFig = {...fig};
+
+            // Hide all the barriers, and drop the sphere and the traversal traces of the previous click
+                updatedFig.data = fig.data
+                    .filter(trace => !ANIMATION_TRACES.includes(trace.name))
+                    .map(trace => {
+                        if (trace.type === 'mesh3d' || trace.type === 'surface') {
+                            return {...trace, visible: false};
+                        }
+                        return trace;
+                    });
+
+            // Searches the tree and generates frames for the tree traversal, unless this sphere was just asked for,
+            // the frames update the traversal traces that come right after the figure's own traces
+                const {results, found, animation} = cachedQuery(tree, updatedFig, a, b, c, r, version);
+                updatedFig.frames = animation.frames;
+                updatedFig.data.push(...animation.traces);
 
             // Create the Sphere and add it to the figure data
                 const sphere = createSphere(a, b, c, r);
@@ -137,28 +185,26 @@ function createSphere(a, b, c, r) {
 }
 
 function createTraversalAnimation(fig, coors, neighbs) {
-// Deep copy of input data
-    const updatedFig = JSON.parse(JSON.stringify(fig));
-
-// Ensure all scatter trace markers to black if the figure was used before :)
-    updatedFig.data.forEach(trace => {
-        if (trace.type === 'scatter' && trace.hoverinfo === 'text') {
-            trace.marker = { 
-                ...trace.marker, 
-                color: 'black', 
-                size: 15 
-            };
-        }
-    });
-    
-// Separate scatter and surface traces
-    const scatterList = updatedFig.data
-        .filter(trace => trace.type === 'scatter')
-        .map(trace => ({...trace}));
+// Frames only carry the traces that change, addressed by their index in the figure with `traces`, so the
+// animation grows with the number of visited nodes instead of the size of the tree. Those are two traces put
+// at the end of fig.data: markers on top of the visited nodes of the 2D Representation, whose colors are
+// one array, and the grey plane of the node being visited. The traces are returned with the frames
+    const traversalIndex = fig.data.length;
+    const barrierIndex = traversalIndex + 1;
+    const markers = fig.data.find(trace => trace.type === 'scatter' && trace.hoverinfo === 'text');
     
-    const surfaceList = updatedFig.data
-        .filter(trace => trace.type === 'surface')
-        .map(trace => ({...trace}));
+// The barriers of a level are one mesh with four corners per barrier (see barrier_meshes), and the mesh's meta
+// has the name "(x, y, z)" of every barrier's node, which is read back as numbers since python writes 50 as 50.0
+    const barrierCorners = new Map();
+    fig.data
+        .filter(trace => trace.type === 'mesh3d')
+        .forEach(mesh => {
+            const corners = [plotlyArray(mesh.x), plotlyArray(mesh.y), plotlyArray(mesh.z)];
+            (mesh.meta || []).forEach((name, b) => {
+                const key = name.slice(1, -1).split(', ').map(Number).join(',');
+                barrierCorners.set(key, {corners: corners, first: 4 * b});
+            });
+        });
 
     const checkingNodeColor = 'orange';
     const neighboringNodeColor = 'green';
@@ -171,25 +217,50 @@ function createTraversalAnimation(fig, coors, neighbs) {
     var neighborNodes = new Set();
     var checkedNodes = new Set();
 
-// Create trace dictionary for coordinate mapping for quick access (again like the python implementation)
-    const traceDict = {};
-    scatterList.forEach(trace => {
-        if (trace.hoverinfo === 'text') {
-            const coordinate = [trace.x[0], trace.y[0]];
-            traceDict[coordinate] = {...trace, marker: {color: "black", size: 15}};
+// Every visited node gets one marker, in the order they are first visited, and they all start black
+    const markerIndex = new Map();
+    const traversalX = [];
+    const traversalY = [];
+    coors.forEach(([treeCoor]) => {
+        const key = treeCoor.join(',');
+        if (!markerIndex.has(key)) {
+            markerIndex.set(key, traversalX.length);
+            traversalX.push(treeCoor[0]);
+            traversalY.push(treeCoor[1]);
         }
     });
+    const colors = new Array(traversalX.length).fill('black');
+
+    const traversal = {
+        type: 'scatter',
+        x: traversalX,
+        y: traversalY,
+        mode: 'markers',
+        marker: {...(markers ? markers.marker : {}), color: colors.slice()},
+        xaxis: markers ? markers.xaxis : undefined,
+        yaxis: markers ? markers.yaxis : undefined,
+        hoverinfo: 'skip',
+        showlegend: false,
+        name: 'traversal'
+    };
+    const barrier = {
+        type: 'mesh3d',
+        x: [],
+        y: [],
+        z: [],
+        i: [0, 0],
+        j: [1, 2],
+        k: [2, 3],
+        color: 'grey',
+        opacity: 1,
+        hoverinfo: 'skip',
+        name: 'current barrier'
+    };
 
-
-// Include 3D scatter plot points
-    const pointsList = fig.data.filter(trace => trace.type === 'scatter3d');
-    scatterList.push(...pointsList);
+    var previousKey = null;
     
 // Iterate through all the neighbors
     for (let i = 0; i < neighbs.length; i++) {
-    // Create a deep copy of the 2D scatters that we are modifying
-        var updatedData = JSON.parse(JSON.stringify(scatterList));
-
     // This value simply keeps the coordinate values according to if its in range of the coors array
         var coorsIterationValue;
     // treeCoor refers to the 2D Representation, graphCoor refers to the 3D Representation
@@ -221,55 +292,53 @@ function createTraversalAnimation(fig, coors, neighbs) {
             [ax, ay] = [50, -40];  // Right
         }
 
-    // Get the plane with the corresponding node that is in the plane for the given coordinate
-        let plane = null;
-        surfaceList.forEach(surface => {
-            const formattedGraphCoor = `(${graphCoor.join(', ')})`;
-            if (surface.name === formattedGraphCoor) {
-                surface.colorscale = 'Greys';
-                surface.opacity = 1;
-                plane = surface;
-            }
-        });
-    // If we have successfully found the plane with right coordinate add it to the updatdData for the frame
-        if (plane) updatedData.push(plane);
-
-    //We go through all the traces of the updateData
-        updatedData = updatedData.map(trace => {
-        // Only modify scatter traces in 2D
-            if (trace.type === 'scatter') {
-              const coordinate = [trace.x[0], trace.y[0]];
-              const coordinateKey = coordinate.join(',');
-              
-            // Check if this trace represents a node and not an edge
-              const isTreeNode = coordinate.length === 2 && trace.hoverinfo === 'text';
-              
-              if (isTreeNode) {
-            //Coloring Logic below YAY
-                const isNodeBeingVisited = coordinateKey === treeCoor.join(',') && !isLastFrame
-                const isNodeAlreadyNeighbor = neighborNodes.has(coordinateKey)
-                const isNodeNeighbor = neighbs[i] && coordinateKey === neighbs[i].join(',')
-                const isNodeStranger = checkedNodes.has(coordinateKey) && !neighborNodes.has(coordinateKey)
-
-                if (isNodeBeingVisited) {
-                    trace.marker = { ...trace.marker, color: checkingNodeColor };
-                    checkedNodes.add(coordinateKey);
-                } else if (isNodeAlreadyNeighbor) {
-                  trace.marker = { ...trace.marker, color: neighboringNodeColor };
-                } else if (isNodeNeighbor) {
-                  trace.marker = { ...trace.marker, color: neighboringNodeColor };
-                  neighborNodes.add(coordinateKey);
-                } else if (isNodeStranger) {
-                  trace.marker = { ...trace.marker, color: strangerNodeColor };
-                }
-              }
+    // Move the grey plane to the barrier of the node that is visited, or hide it if the node has none
+        let plane = {visible: false};
+        const corners = barrierCorners.get(graphCoor.join(','));
+        if (corners) {
+            const [xs, ys, zs] = corners.corners;
+            const end = corners.first + 4;
+            plane = {
+                x: Array.from(xs.slice(corners.first, end)),
+                y: Array.from(ys.slice(corners.first, end)),
+                z: Array.from(zs.slice(corners.first, end)),
+                visible: true,
+                name: `(${graphCoor.join(', ')})`
+            };
+        }
+
+    // Only the node being visited, the neighbor found by the last visit and the node visited before can change color
+        const visitedKey = treeCoor.join(',');
+        const neighborKey = neighbs[i] ? neighbs[i].join(',') : null;
+        for (const coordinateKey of new Set([visitedKey, neighborKey, previousKey])) {
+            const k = markerIndex.get(coordinateKey);
+            if (k === undefined) continue;
+        //Coloring Logic below YAY
+            const isNodeBeingVisited = coordinateKey === visitedKey && !isLastFrame
+            const isNodeAlreadyNeighbor = neighborNodes.has(coordinateKey)
+            const isNodeNeighbor = coordinateKey === neighborKey
+            const isNodeStranger = checkedNodes.has(coordinateKey) && !neighborNodes.has(coordinateKey)
+
+            if (isNodeBeingVisited) {
+                colors[k] = checkingNodeColor;
+                checkedNodes.add(coordinateKey);
+            } else if (isNodeAlreadyNeighbor) {
+                colors[k] = neighboringNodeColor;
+            } else if (isNodeNeighbor) {
+                colors[k] = neighboringNodeColor;
+                neighborNodes.add(coordinateKey);
+            } else if (isNodeStranger) {
+                colors[k] = strangerNodeColor;
+            } else {
+                colors[k] = 'black';
             }
-            return trace;
-          });
+        }
+        previousKey = visitedKey;
 
-    // Create frame with updated data and arrow
+    // Create frame with the updated traces and arrow
         const frame = {
-            data: updatedData,
+            data: [{marker: {color: colors.slice()}}, plane],
+            traces: [traversalIndex, barrierIndex],
             layout: {
                 annotations: [{
                     x: treeCoor[0],
@@ -293,7 +362,7 @@ function createTraversalAnimation(fig, coors, neighbs) {
         
         frames.push(frame);
     }
-    return frames;
+    return {traces: [traversal, barrier], frames: frames};
 }
 
 function createAlert(message, type) {
@@ -321,6 +390,46 @@ function createAlert(message, type) {
     } 
 }
 
+// Typed array for every dtype name written by KDTree.to_flat_dict, and for the short ones plotly uses for NumPy arrays
+const TYPED_ARRAYS = {
+    "float64": Float64Array,
+    "float32": Float32Array,
+    "int32": Int32Array,
+    "int16": Int16Array,
+    "uint8": Uint8Array,
+    "f8": Float64Array,
+    "f4": Float32Array,
+    "i4": Int32Array,
+    "i2": Int16Array,
+    "i1": Int8Array,
+    "u4": Uint32Array,
+    "u2": Uint16Array,
+    "u1": Uint8Array
+};
+
+function decodeArray(entry) {
+// Base64 to raw bytes, which are then viewed as the typed array without copying them again
+    const binary = atob(entry.data !== undefined ? entry.data : entry.bdata);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new TYPED_ARRAYS[entry.dtype](bytes.buffer);
+}
+
+function plotlyArray(value) {
+// Newer plotly versions send NumPy arrays of a figure as {dtype, bdata} instead of plain lists
+    return Array.isArray(value) ? value : decodeArray(value);
+}
+
+function loadTree(treeData) {
+// The flat export (KDTree.to_flat_dict) is read into typed arrays, the nested one (KDTree.to_dict) into KDNodes
+    if (treeData.format === "flat") {
+        return new FlatKDTree(treeData);
+    }
+    return new KDTree(treeData);
+}
+
 const LEVEL_DICT = {
     "X": 0,
     "Y": 1,
@@ -341,8 +450,11 @@ class KDTree {
         return found
     }
     
-    findSphereNeighbors(a,b,c,r,neighbors = [], traversalCoordinates = [], inorderNeighbors = [null]){
-    //Code pretty similar to the Python implementation
+    findSphereNeighbors(a,b,c,r,trace = false){
+    //Code pretty similar to the Python implementation, the traversal is only recorded when tracing for the animation
+        let neighbors = []
+        let traversalCoordinates = trace ? [] : null
+        let inorderNeighbors = trace ? [null] : null
         let isCenterFound = this.find(a,b,c)
         if (this.root){
             this.root.findSphereNeighbors(a,b,c,r,neighbors,traversalCoordinates,inorderNeighbors)
@@ -362,32 +474,34 @@ class KDNode {
         this.inorderPos = data.inorder_pos;
         this.depth = data.depth;
         this.level = data.level;
+    // Removed points are still exported (as tombstones) so the drawing keeps its shape, but they are never found
+        this.deleted = data.deleted || false;
         this.left = data.left ? new KDNode(data.left) : null;
         this.right = data.right ? new KDNode(data.right) : null;
     }
 
     find(x,y,z){
-    //Code very similar to python implementation
+    //Code very similar to python implementation, a point only ever has one node and ties go right
         var ret = false
         if (this.x === x && this.y === y && this.z === z){
-            ret = true
+            return !this.deleted
         }
         if (this.level === "X"){
             if (x < this.x && this.left){
                 ret = this.left.find(x,y,z)
-            } else if (x > this.x && this.right){
+            } else if (x >= this.x && this.right){
                 ret = this.right.find(x,y,z)
             }
         } else if (this.level === "Y"){
             if (y < this.y && this.left){
                 ret = this.left.find(x,y,z)
-            } else if (y > this.y && this.right){
+            } else if (y >= this.y && this.right){
                 ret = this.right.find(x,y,z)
             }
         } else if (this.level === "Z"){
             if (z < this.z && this.left){
                 ret = this.left.find(x,y,z)
-            } else if (z > this.z && this.right){
+            } else if (z >= this.z && this.right){
                 ret = this.right.find(x,y,z)
             }
         }
@@ -402,16 +516,19 @@ class KDNode {
         var current_point_2D_val = [this.inorderPos, this.depth]
         var center_point = [a,b,c]
         var isCenter = current_point === center_point
-    // Add the current coordinate to the traversal coordinates
-        let coordinateList = [current_point_2D_val, current_point]
-        traversalCoordinates.push(coordinateList)
+    // Add the current coordinate to the traversal coordinates (only when tracing)
+        if (traversalCoordinates){
+            traversalCoordinates.push([current_point_2D_val, current_point])
+        }
 
-        if (distance <= r){
-            inorderNeighbors.push(current_point_2D_val)
+        if (distance <= r && !this.deleted){
+            if (inorderNeighbors){
+                inorderNeighbors.push(current_point_2D_val)
+            }
             if (!isCenter){
                 neighbors.push(current_point)
             }
-        } else {
+        } else if (inorderNeighbors){
             inorderNeighbors.push(null)
         }
 
@@ -435,4 +552,79 @@ class KDNode {
         }
 
     }
-};
\ No newline at end of file
+};
+
+class FlatKDTree {
+    constructor(data){
+    // Every node is a row of these arrays, numbered in preorder with -1 standing for a missing child
+        const arrays = data.arrays;
+        this.size = data.size;
+        this.root = data.root;
+        this.coords = decodeArray(arrays.coords);
+        this.left = decodeArray(arrays.left);
+        this.right = decodeArray(arrays.right);
+        this.axis = decodeArray(arrays.axis);
+        this.inorderPos = decodeArray(arrays.inorder_pos);
+        this.depth = decodeArray(arrays.depth);
+        this.deleted = arrays.deleted ? decodeArray(arrays.deleted) : null;
+    }
+
+    find(a,b,c){
+    // Same walk as KDNode.find, a point only ever has one row and ties go right
+        const center = [a,b,c];
+        let row = this.root;
+        while (row !== -1){
+            const x = this.coords[3*row], y = this.coords[3*row + 1], z = this.coords[3*row + 2];
+            if (x === a && y === b && z === c){
+                return !(this.deleted && this.deleted[row]);
+            }
+            const axis = this.axis[row];
+            row = center[axis] < this.coords[3*row + axis] ? this.left[row] : this.right[row];
+        }
+        return false
+    }
+
+    findSphereNeighbors(a,b,c,r,trace = false){
+    // Returns the same values as KDTree.findSphereNeighbors, the stack visits the rows in the same order as
+    // the recursion of KDNode.findSphereNeighbors (the near child's subtree, then the far child's)
+        let neighbors = []
+        let traversalCoordinates = trace ? [] : null
+        let inorderNeighbors = trace ? [null] : null
+        const isCenterFound = this.find(a,b,c)
+        const center = [a,b,c];
+        const stack = this.root !== -1 ? [this.root] : [];
+        while (stack.length){
+            const row = stack.pop();
+            const x = this.coords[3*row], y = this.coords[3*row + 1], z = this.coords[3*row + 2];
+            const point = [x, y, z];
+            const point2D = [this.inorderPos[row], this.depth[row]];
+            if (trace){
+                traversalCoordinates.push([point2D, point]);
+            }
+            const distance = Math.sqrt((x - a) ** 2 + (y - b) ** 2 + (z - c) ** 2);
+            if (distance <= r && !(this.deleted && this.deleted[row])){
+                if (trace){
+                    inorderNeighbors.push(point2D);
+                }
+                neighbors.push(point);
+            } else if (trace){
+                inorderNeighbors.push(null);
+            }
+
+            const axis = this.axis[row];
+            const diff = center[axis] - point[axis];
+            const near = diff < 0 ? this.left[row] : this.right[row];
+            const far = diff < 0 ? this.right[row] : this.left[row];
+            if (far !== -1 && Math.abs(diff) <= r){
+                stack.push(far);
+            }
+            if (near !== -1){
+                stack.push(near);
+            }
+        }
+    // Remove the Center since its a neighbor of itself
+        neighbors = neighbors.filter(point => !(point[0] === a && point[1] === b && point[2] === c));
+        neighbors.sort()
+        return [neighbors, isCenterFound, traversalCoordinates, inorderNeighbors]
+    }
+};
@@ -0,0 +1,800 @@
+import math
+import json
+import heapq
+import numpy as np
+
+from tree import LEVELS, EPSILON, median_split, cached_query
+
+# Value stored in the child arrays when a node does not have that child
+NO_CHILD = -1
+
+# Number of rows the arrays start with, they double in size whenever they fill up
+INITIAL_CAPACITY = 16
+
+# Bucket sizes are stored as uint16, so a leaf can hold at most this many points
+MAX_LEAF_SIZE = np.iinfo(np.uint16).max
+
+# First bytes of a file written by FlatKDTree.save, followed by the header length as a little endian uint64
+MAGIC = b"DASH3DKD"
+
+# Every array in a saved file starts at a multiple of this many bytes, so memory maps of it stay aligned
+ALIGNMENT = 64
+
+
+class FlatKDTree:
+    """
+    Array backed version of the KDTree, instead of one KDNode object per point every point is a row in
+    a contiguous float64 (N, 3) coordinate array, and the children and splitting axes live in int32/uint8 arrays
+    indexed by the same row number. It has the same add, find, find_sphere_neighbors, inorder and to_dict
+    methods as the KDTree, so either one can be used by the app
+
+    A tree built with a leaf_size keeps small subtrees as leaf buckets: the leaf's row is followed by the rows
+    of the rest of its bucket, and bucket[row] says how many rows the leaf owns (1 for a normal node, 0 for the
+    rows inside a bucket), so a bucket is checked with one NumPy operation instead of one node at a time
+    """
+    def __init__(self, capacity = INITIAL_CAPACITY):
+        capacity = max(int(capacity), 1)
+        self.coords = np.empty((capacity, 3), dtype = np.float64)
+        self.left = np.full(capacity, NO_CHILD, dtype = np.int32)
+        self.right = np.full(capacity, NO_CHILD, dtype = np.int32)
+        self.axis = np.zeros(capacity, dtype = np.uint8)
+        self.bucket = np.ones(capacity, dtype = np.uint16)
+    # Id of each row's point (its position in insertion order, or the id it had in a KDTree),
+    # None while that is simply the row number
+        self.ids = None
+        self.next_id = 0
+    # How many times each row's point was added to the KDTree it came from, None while every count is 1
+        self.counts = None
+    # Id indexed payload columns of the KDTree the tree was copied from, only kept so they are saved with it
+        self.columns = {}
+        self.size = 0
+        self.root = NO_CHILD
+        self.min_overall_val = None
+        self.max_overall_val = None
+    # The 2D Representation (inorder position and depth of each row) is only computed when something needs it
+        self.inorder_pos = None
+        self.depth = None
+    # The cell of every row (the box of space it splits), also only computed when a search needs it
+        self.cells = None
+    # Bumped by add, find and find_sphere_neighbors answer from query_cache (a QueryCache, when one is set)
+    # as long as the version is the same
+        self.version = 0
+        self.query_cache = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        """
+        Returns:
+            int: bytes used by the arrays of the tree, including any unused capacity
+        """
+        arrays = [self.coords, self.left, self.right, self.axis, self.bucket, self.ids, self.counts,
+                  self.inorder_pos, self.depth, self.cells]
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    @classmethod
+    def from_points(cls, points, leaf_size = 1):
+        """
+        Builds a balanced tree from many points at once, the same way KDTree.from_points does
+
+        Args:
+            points (np.ndarray or iterable): an (N, 3) array or any iterable of (x, y, z) triples
+            leaf_size (int): subtrees with at most this many points become a single leaf bucket
+
+        Returns:
+            FlatKDTree: the balanced tree containing every point
+        """
+        points = np.asarray(points if isinstance(points, np.ndarray) else list(points), dtype = np.float64)
+        if not 1 <= leaf_size <= MAX_LEAF_SIZE:
+            raise ValueError(f"leaf_size has to be between 1 and {MAX_LEAF_SIZE}, got {leaf_size}")
+        if points.size == 0:
+            return cls()
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError(f"Expected an (N, 3) array of points, got shape {points.shape}")
+
+        n = len(points)
+        root, left, right, depth, owner = median_split(points, leaf_size = leaf_size)
+        tree = cls(capacity = n)
+        if leaf_size == 1:
+            tree.coords[:] = points
+            tree.left[:] = left
+            tree.right[:] = right
+            tree.axis[:] = depth % 3
+        else:
+        # Lay the nodes out in preorder with every leaf followed by the rest of its bucket
+            members = np.nonzero(owner >= 0)[0]
+            members = members[np.argsort(owner[members], kind = 'stable')]
+            counts = np.bincount(owner[members], minlength = n)
+            firsts = np.cumsum(counts) - counts
+            members, counts, firsts = members.tolist(), counts.tolist(), firsts.tolist()
+            left_list, right_list = left.tolist(), right.tolist()
+            order = []
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                order.append(node)
+                order.extend(members[firsts[node]:firsts[node] + counts[node]])
+                if right_list[node] >= 0:
+                    stack.append(right_list[node])
+                if left_list[node] >= 0:
+                    stack.append(left_list[node])
+            order = np.array(order, dtype = np.int64)
+            rows = np.empty(n, dtype = np.int64)
+            rows[order] = np.arange(n)
+
+            tree.coords[:] = points[order]
+            tree.left[:] = np.where(left[order] >= 0, rows[left[order]], NO_CHILD)
+            tree.right[:] = np.where(right[order] >= 0, rows[right[order]], NO_CHILD)
+            tree.axis[:] = depth[order] % 3
+            tree.bucket[:] = np.where(owner[order] >= 0, 0, 1 + np.bincount(owner[members], minlength = n)[order])
+            tree.ids = order
+            root = rows[root]
+        tree.size = n
+        tree.next_id = n
+        tree.root = int(root)
+        tree.min_overall_val = points.min() - EPSILON
+        tree.max_overall_val = points.max() + EPSILON
+        return tree
+
+    @classmethod
+    def from_tree(cls, kdtree):
+        """
+        Copies a KDTree made of KDNodes into the flat arrays, keeping the exact same shape and the ids of the
+        points (a repeated point is copied once, with its count in counts), a tree with removed points
+        (tombstones) is rebuilt from its remaining points instead
+
+        Args:
+            kdtree (KDTree): the tree to copy
+
+        Returns:
+            FlatKDTree: the copied tree
+        """
+        if kdtree.root and kdtree.root.dead:
+            points, counts, ids = [], [], []
+            kdtree.root.points(points, counts, ids)
+            tree = cls.from_points(np.array(points, dtype = float).reshape(-1, 3))
+        # Without leaf buckets from_points keeps the points in the rows they were given in
+            tree.ids = np.array(ids, dtype = np.int64)
+            if max(counts) > 1:
+                tree.counts = np.array(counts, dtype = np.int64)
+            tree.next_id = kdtree.next_id
+            tree.min_overall_val = kdtree.min_overall_val
+            tree.max_overall_val = kdtree.max_overall_val
+            return tree
+        nodes = []
+        stack = [kdtree.root] if kdtree.root else []
+    # Number the nodes in preorder, so a parent always gets its row before its children
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.right:
+                stack.append(node.right)
+            if node.left:
+                stack.append(node.left)
+
+        tree = cls(capacity = len(nodes))
+        tree.ids = np.zeros(len(tree.coords), dtype = np.int64)
+        counts = np.ones(len(tree.coords), dtype = np.int64)
+        rows = {id(node): row for row, node in enumerate(nodes)}
+        for row, node in enumerate(nodes):
+            tree.coords[row] = (node.x, node.y, node.z)
+            tree.ids[row] = node.id
+            counts[row] = node.count
+            tree.axis[row] = LEVELS.index(node.level)
+            if node.left:
+                tree.left[row] = rows[id(node.left)]
+            if node.right:
+                tree.right[row] = rows[id(node.right)]
+        if (counts > 1).any():
+            tree.counts = counts
+        tree.size = len(nodes)
+        tree.next_id = kdtree.next_id
+        tree.root = 0 if nodes else NO_CHILD
+        tree.min_overall_val = kdtree.min_overall_val
+        tree.max_overall_val = kdtree.max_overall_val
+        return tree
+
+    def _grow(self):
+    # Doubles the capacity of every array, keeping the rows used so far
+        capacity = 2 * len(self.coords)
+        coords = np.empty((capacity, 3), dtype = np.float64)
+        coords[:self.size] = self.coords[:self.size]
+        self.coords = coords
+        for name in ('left', 'right'):
+            array = np.full(capacity, NO_CHILD, dtype = np.int32)
+            array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+        axis = np.zeros(capacity, dtype = np.uint8)
+        axis[:self.size] = self.axis[:self.size]
+        self.axis = axis
+        bucket = np.ones(capacity, dtype = np.uint16)
+        bucket[:self.size] = self.bucket[:self.size]
+        self.bucket = bucket
+        if self.ids is not None:
+            ids = np.zeros(capacity, dtype = np.int64)
+            ids[:self.size] = self.ids[:self.size]
+            self.ids = ids
+        if self.counts is not None:
+            counts = np.ones(capacity, dtype = np.int64)
+            counts[:self.size] = self.counts[:self.size]
+            self.counts = counts
+
+    def _new_row(self, x, y, z, axis):
+        if self.size == len(self.coords):
+            self._grow()
+        row = self.size
+        self.coords[row] = (x, y, z)
+        self.axis[row] = axis
+        self.bucket[row] = 1
+        if self.ids is not None:
+            self.ids[row] = self.next_id
+        if self.counts is not None:
+            self.counts[row] = 1
+        self.next_id += 1
+        self.size += 1
+        return row
+
+    def _to_ids(self, rows):
+    # Turns rows into the ids the caller knows the points by
+        return rows if self.ids is None else self.ids[rows]
+
+    def add(self, x, y, z):
+        """
+        Adds a point to the tree, walking down from the root until there is an empty child for it,
+        like KDNode.add except the new point is a new row in the arrays, ties go right the same way
+        but a repeated point gets a row of its own instead of a count.
+        A leaf bucket is not split, the new point becomes a child of the leaf's own point
+
+        Args:
+            x (float): an x-coordinate of the node to be added
+            y (float): an y-coordinate of the node to be added
+            z (float): an z-coordinate of the node to be added
+        """
+        point = (x, y, z)
+        if self.root == NO_CHILD:
+            self.root = self._new_row(x, y, z, 0)
+            self.min_overall_val = min(point) - EPSILON
+            self.max_overall_val = max(point) + EPSILON
+        else:
+        # Keep the min and max overall values around every point, like KDTree.add
+            self.min_overall_val = min(self.min_overall_val, min(point) - EPSILON)
+            self.max_overall_val = max(self.max_overall_val, max(point) + EPSILON)
+            row = self.root
+            while True:
+                axis = self.axis[row]
+                side = 'left' if point[axis] < self.coords[row, axis] else 'right'
+                child = getattr(self, side)[row]
+                if child == NO_CHILD:
+                # Adding the row can grow the arrays, so look the child array up again afterwards
+                    child = self._new_row(x, y, z, (axis + 1) % 3)
+                    getattr(self, side)[row] = child
+                    break
+                row = child
+    # The inorder positions, depths and cells have to be recomputed now
+        self.inorder_pos = None
+        self.depth = None
+        self.cells = None
+        self.version += 1
+
+    def _layout(self):
+    # Computes the inorder position and depth of every row for the 2D Representation, if it is out of date
+        if self.inorder_pos is not None:
+            return
+        inorder_pos = np.zeros(self.size, dtype = np.int32)
+        depth = np.zeros(self.size, dtype = np.int32)
+        left = self.left
+        right = self.right
+        num = 0
+        stack = []
+        row = self.root
+        current_depth = 0
+        bucket = self.bucket
+    # Iterative inorder traversal, the depth goes down in negative numbers like KDNode.find_depths
+    # The rest of a leaf's bucket comes right after the leaf, at the same depth
+        while stack or row != NO_CHILD:
+            while row != NO_CHILD:
+                depth[row] = current_depth
+                stack.append(row)
+                row = left[row]
+                current_depth -= 1
+            row = stack.pop()
+            owned = int(bucket[row])
+            inorder_pos[row:row + owned] = np.arange(num, num + owned)
+            depth[row:row + owned] = depth[row]
+            num += owned
+            current_depth = depth[row] - 1
+            row = right[row]
+        self.inorder_pos = inorder_pos
+        self.depth = depth
+
+    def _cells(self):
+    # Computes the low and high corner of every row's cell, if it is out of date, one level of rows at a time from the root
+    # (whose cell is all of space), every child gets its parent's cell cut at the parent's splitting value
+        if self.cells is not None:
+            return self.cells
+        cells = np.empty((self.size, 2, 3), dtype = np.float64)
+        cells[:, 0] = -np.inf
+        cells[:, 1] = np.inf
+        rows = np.array([self.root] if self.root != NO_CHILD else [], dtype = np.int64)
+        while len(rows):
+            axis = self.axis[rows].astype(np.int64)
+            value = self.coords[rows, axis]
+            children = []
+            for side, corner in ((self.left, 1), (self.right, 0)):
+                child = side[rows].astype(np.int64)
+                has = child != NO_CHILD
+                cells[child[has]] = cells[rows[has]]
+                cells[child[has], corner, axis[has]] = value[has]
+                children.append(child[has])
+            rows = np.concatenate(children)
+        self.cells = cells
+        return cells
+
+    def inorder(self):
+        """
+        Returns:
+            key_list (list): the (x, y, z) coordinates of every point in inorder
+        """
+        if self.root == NO_CHILD:
+            return []
+        self._layout()
+        order = np.argsort(self.inorder_pos)
+        return [tuple(point) for point in self.coords[order].tolist()]
+
+    @cached_query
+    def find(self, x, y, z, trace = False):
+        """
+        Finds if the target node is in the Tree, when tracing it also records the path to the target node,
+        along with the distance between the target node and the nodes traversed to the target node using the distance formula
+
+        Args:
+            x (float): an x-coordinate of the node to be found
+            y (float): an y-coordinate of the node to be found
+            z (float): an z-coordinate of the node to be found
+            trace (bool): records the path for drawing it, leave it off when only the answer is needed
+
+        Returns:
+            found (bool): True if the node is found in the tree, False otherwise
+            path (dict): keys refer to the intermediary nodes between the root and the target node (2D Tree)
+                              values refer to the distance between the intermediary nodes and the target node,
+                              and the (x,y,z) coordinate in the 3D Tree, empty unless trace is True
+        """
+        path = {}
+        found = False
+        if self.root == NO_CHILD:
+            return found, path
+
+        if trace:
+            self._layout()
+        target = (x, y, z)
+        row = self.root
+        while row != NO_CHILD:
+            node_x, node_y, node_z = current_point = tuple(self.coords[row].tolist())
+            if trace:
+                distance = math.sqrt((node_x - x)**2 + (node_y - y)**2 + (node_z - z)**2)
+                path[(int(self.inorder_pos[row]), int(self.depth[row]))] = (current_point, distance)
+            found = current_point == target
+            owned = self.bucket[row]
+            if owned > 1 and not found:
+            # The whole bucket is compared with the target at once
+                found = bool((self.coords[row + 1:row + owned] == target).all(axis = 1).any())
+            if found:
+                break
+            axis = self.axis[row]
+            if target[axis] < current_point[axis]:
+                row = self.left[row]
+            else:
+                row = self.right[row]
+        return found, path
+
+    @cached_query
+    def find_sphere_neighbors(self, a, b, c, r, trace = False):
+        """
+        Finds the Sphere's neighbors that are within the sphere by checking if its inside the sphere,
+        the nodes are visited in the same order as KDNode.find_sphere_neighbors so a traced animation matches
+
+        Args:
+            a (float): x-coordinate of the center of the sphere
+            b (float): y-coordinate of the center of the sphere
+            c (float): z-coordinate of the center of the sphere
+            r (float): radius of the sphere
+            trace (bool): records the traversal for the animation
+
+        Returns:
+            neighbors (list): all the neighbors in the sphere
+            isCenterFound (bool): True if the center of the sphere is in the tree, False otherwise
+            traversal_coordinates (list): contains a sublist of the 2D Coordinate and 3D Coordinates of traversed neighbors,
+            None unless trace is True
+            inorder_neighbors (list): if there are no neighbors in the current traversal, it will be None,
+            otherwise it has the 2D coordinate, None unless trace is True
+        """
+        neighbors = []
+        traversal_coordinates = None
+        inorder_neighbors = None
+        if trace:
+            traversal_coordinates = []
+            inorder_neighbors = [None]
+            self._layout()
+        isCenterFound, path = self.find(a, b, c)
+        center_point = (a, b, c)
+        r2 = r * r if r >= 0 else -1.0
+        stack = [self.root] if self.root != NO_CHILD else []
+        while stack:
+            row = stack.pop()
+            current_point = tuple(self.coords[row].tolist())
+            dx, dy, dz = current_point[0] - a, current_point[1] - b, current_point[2] - c
+            inside = dx*dx + dy*dy + dz*dz <= r2
+            if inside and current_point != center_point:
+                neighbors.append(current_point)
+            owned = self.bucket[row]
+            if owned > 1:
+            # The rest of the bucket is checked with a single distance computation
+                points = self.coords[row + 1:row + owned]
+                diff = points - center_point
+                in_bucket = np.einsum('ij,ij->i', diff, diff) <= r2
+                inside = inside or bool(in_bucket.any())
+                neighbors.extend(tuple(point) for point in points[in_bucket].tolist() if tuple(point) != center_point)
+
+            if trace:
+                current_point_2D_val = (int(self.inorder_pos[row]), int(self.depth[row]))
+                traversal_coordinates.append([current_point_2D_val, current_point])
+                inorder_neighbors.append(current_point_2D_val if inside else None)
+
+        # The far side goes on the stack first so the near side is explored first, like the recursive version
+            near, far, gap = self.split(row, center_point)
+            if far != NO_CHILD and gap <= r:
+                stack.append(far)
+            if near != NO_CHILD:
+                stack.append(near)
+        neighbors.sort()
+        return neighbors, isCenterFound, traversal_coordinates, inorder_neighbors
+
+    def split(self, row, point):
+        """
+        Compares a point with a row on the row's splitting axis, the same way KDNode.split does
+
+        Args:
+            row (int): the node's row
+            point (tuple): the (x, y, z) coordinates of the point
+
+        Returns:
+            near (int): row of the child on the point's side of the splitting plane (ties go right)
+            far (int): row of the other child
+            gap (float): distance from the point to the splitting plane
+        """
+        axis = self.axis[row]
+        value = point[axis]
+        split = self.coords[row, axis]
+        if value < split:
+            return self.left[row], self.right[row], float(split - value)
+        return self.right[row], self.left[row], float(value - split)
+
+    def knn(self, x, y, z, k):
+        """
+        Finds the k closest points in the tree to (x, y, z) with a bounded max-heap, like KDTree.knn
+
+        Args:
+            x (float): x-coordinate of the query point
+            y (float): y-coordinate of the query point
+            z (float): z-coordinate of the query point
+            k (int): how many points to find
+
+        Returns:
+            neighbors (list): up to k (x,y,z) coordinates, closest first
+            distances (list): the distance of each of those neighbors to the query point
+        """
+        heap = []
+        point = (x, y, z)
+        stack = [(self.root, 0.0)] if self.root != NO_CHILD and k > 0 else []
+        while stack:
+            row, bound = stack.pop()
+            if len(heap) == k and bound >= -heap[0][0]:
+                continue
+            owned = int(self.bucket[row])
+            if owned == 1:
+                node_x, node_y, node_z = self.coords[row].tolist()
+                dx, dy, dz = node_x - x, node_y - y, node_z - z
+                candidates = [dx*dx + dy*dy + dz*dz]
+            else:
+            # The whole bucket is measured with a single distance computation
+                diff = self.coords[row:row + owned] - point
+                candidates = np.einsum('ij,ij->i', diff, diff).tolist()
+            for offset, d2 in enumerate(candidates):
+                entry = (-d2, row + offset)
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+            near, far, gap = self.split(row, point)
+            if far != NO_CHILD:
+                stack.append((far, max(bound, gap*gap)))
+            if near != NO_CHILD:
+                stack.append((near, bound))
+        heap.sort(reverse = True)
+        neighbors = [tuple(self.coords[row].tolist()) for _, row in heap]
+        distances = [math.sqrt(-neg_distance) for neg_distance, _ in heap]
+        return neighbors, distances
+
+    def _as_centers(self, centers):
+        centers = np.asarray(centers, dtype = np.float64)
+        if centers.ndim == 1:
+            centers = centers.reshape(1, -1)
+        if centers.ndim != 2 or centers.shape[1] != 3:
+            raise ValueError(f"Expected an (M, 3) array of centers, got shape {centers.shape}")
+        return centers
+
+    def sphere_neighbors_batch(self, centers, r):
+        """
+        Finds the points inside many spheres at once, instead of walking the tree once per sphere every
+        (sphere, node) pair still to be checked is kept in NumPy arrays, and a whole level of those pairs is
+        checked with one vectorized distance computation before moving to their children
+
+        Args:
+            centers (np.ndarray): an (M, 3) array with the center of every sphere
+            r (float or np.ndarray): one radius for every sphere, or an (M,) array of radii
+
+        Returns:
+            offsets (np.ndarray): (M + 1,) array, the neighbors of sphere i are indices[offsets[i]:offsets[i + 1]]
+            indices (np.ndarray): ids of the neighbors (the center itself included when it is in the tree), sorted per sphere
+        """
+        centers = self._as_centers(centers)
+        r = np.broadcast_to(np.asarray(r, dtype = np.float64), (len(centers),))
+    # A negative radius holds nothing, like in find_sphere_neighbors
+        offsets, rows = self._sphere_rows(centers, np.where(r >= 0, r * r, -1.0))
+        return offsets, self._to_ids(rows)
+
+    def _sphere_rows(self, centers, r2):
+    # sphere_neighbors_batch, giving back rows instead of ids and taking the squared radii (M,),
+    # so knn_batch can search up to its bound without rounding it through a square root
+        m = len(centers)
+        hit_spheres = []
+        hit_rows = []
+        cells = self._cells()
+        if self.root != NO_CHILD:
+            spheres = np.arange(m)
+            rows = np.full(m, self.root, dtype = np.int64)
+        else:
+            spheres = rows = np.zeros(0, dtype = np.int64)
+        while len(spheres):
+        # Every node is checked together with the rest of its bucket
+            owned = self.bucket[rows].astype(np.int64)
+            firsts = np.cumsum(owned) - owned
+            point_spheres = np.repeat(spheres, owned)
+            point_rows = np.repeat(rows - firsts, owned) + np.arange(owned.sum())
+            point_diff = self.coords[point_rows] - centers[point_spheres]
+            inside = np.einsum('ij,ij->i', point_diff, point_diff) <= r2[point_spheres]
+            hit_spheres.append(point_spheres[inside])
+            hit_rows.append(point_rows[inside])
+        # A child is visited when its whole cell is within r of the center, which also rules out
+        # the cells only the last splitting plane would have let through
+            children = []
+            for side in (self.left, self.right):
+                child = side[rows].astype(np.int64)
+                has = child != NO_CHILD
+                child, child_spheres = child[has], spheres[has]
+                center = centers[child_spheres]
+                gap = np.maximum(np.maximum(cells[child, 0] - center, center - cells[child, 1]), 0)
+                near = np.einsum('ij,ij->i', gap, gap) <= r2[child_spheres]
+                children.append((child_spheres[near], child[near]))
+            spheres = np.concatenate([child_spheres for child_spheres, _ in children])
+            rows = np.concatenate([child for _, child in children])
+
+        spheres = np.concatenate(hit_spheres) if hit_spheres else np.zeros(0, dtype = np.int64)
+        rows = np.concatenate(hit_rows) if hit_rows else np.zeros(0, dtype = np.int64)
+    # Group the hits by sphere into CSR form
+        offsets = np.zeros(m + 1, dtype = np.int64)
+        np.cumsum(np.bincount(spheres, minlength = m), out = offsets[1:])
+        return offsets, rows[np.lexsort((rows, spheres))]
+
+    def knn_batch(self, centers, k):
+        """
+        Finds the k closest points to many query points at once. Every query first walks straight down to a leaf
+        (all queries together, one level per step), the k-th closest point on that path bounds the answer.
+        Batched sphere searches then start from a guessed radius and grow it by half only for the queries that
+        still have fewer than k points inside, and the k closest of those are kept
+
+        Args:
+            centers (np.ndarray): an (M, 3) array of query points
+            k (int): how many points to find for every query
+
+        Returns:
+            offsets (np.ndarray): (M + 1,) array, the neighbors of query i are indices[offsets[i]:offsets[i + 1]]
+            indices (np.ndarray): ids of the neighbors, closest first for every query
+            distances (np.ndarray): the distance of each neighbor to its query point
+        """
+        centers = self._as_centers(centers)
+        m = len(centers)
+        k = min(int(k), self.size)
+        if k <= 0:
+            return np.zeros(m + 1, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+
+    # seen holds the k smallest squared distances every query passes on its way down (the leaves' own points only)
+        seen = np.full((m, k), np.inf)
+        queries = np.arange(m)
+        rows = np.full(m, self.root, dtype = np.int64)
+        while len(queries):
+            diff = self.coords[rows] - centers[queries]
+            d2 = np.einsum('ij,ij->i', diff, diff)
+            worst = seen[queries].argmax(axis = 1)
+            better = d2 < seen[queries, worst]
+            seen[queries[better], worst[better]] = d2[better]
+            delta = diff[np.arange(len(rows)), self.axis[rows]]
+            rows = np.where(delta > 0, self.left[rows], self.right[rows]).astype(np.int64)
+            queries = queries[rows != NO_CHILD]
+            rows = rows[rows != NO_CHILD]
+    # A path shorter than k leaves the bound at infinity, so the first radius is a guess: a ball around the
+    # closest point seen holding k times as much space, or the size a ball of k points would have if the
+    # points were spread evenly when the query point itself is in the tree
+    # The radii are kept squared, the point exactly at the bound has to stay inside the last search
+        bound2 = seen.max(axis = 1)
+        closest = np.sqrt(seen.min(axis = 1))
+        spread = (self.max_overall_val - self.min_overall_val) * (k / self.size) ** (1 / 3) / 2
+        radius2 = np.where(closest > 0, closest * k ** (1 / 3), spread) ** 2
+
+        found_queries = []
+        found_rows = []
+        pending = np.arange(m)
+        while len(pending):
+        # Once the radius reaches the bound there are always at least k points inside
+            radius2 = np.minimum(radius2, bound2[pending])
+            offsets, indices = self._sphere_rows(centers[pending], radius2)
+            done = (np.diff(offsets) >= k) | (radius2 >= bound2[pending])
+            found = np.repeat(done, np.diff(offsets))
+            found_queries.append(np.repeat(pending, np.diff(offsets))[found])
+            found_rows.append(indices[found])
+            pending = pending[~done]
+        # Growing the radius by half grows its square by 2.25
+            radius2 = 2.25 * radius2[~done]
+
+    # Keep the k closest candidates of every query, sorted by distance
+        queries = np.concatenate(found_queries)
+        rows = np.concatenate(found_rows)
+        diff = self.coords[rows] - centers[queries]
+        d2 = np.einsum('ij,ij->i', diff, diff)
+        order = np.lexsort((rows, d2, queries))
+        starts = np.zeros(m, dtype = np.int64)
+        np.cumsum(np.bincount(queries, minlength = m)[:-1], out = starts[1:])
+        keep = order[np.arange(len(order)) - starts[queries[order]] < k]
+    # Counted per query rather than assumed to be k each, so one short query can't shift the ones after it
+        offsets = np.zeros(m + 1, dtype = np.int64)
+        np.cumsum(np.bincount(queries[keep], minlength = m), out = offsets[1:])
+        return offsets, self._to_ids(rows[keep]), np.sqrt(d2[keep])
+
+    def to_dict(self):
+        """
+        Exports the tree in the same nested format as KDTree.to_dict for the clientside callback
+
+        Returns:
+            dict: the root's dictionary with its children nested inside, None if the tree is empty
+        """
+        if self.root == NO_CHILD:
+            return None
+        self._layout()
+        dicts = [
+            {
+                "x": x,
+                "y": y,
+                "z": z,
+                "inorder_pos": inorder_pos,
+                "depth": depth,
+                "level": LEVELS[axis],
+                "left": None,
+                "right": None
+            }
+            for (x, y, z), inorder_pos, depth, axis in zip(self.coords[:self.size].tolist(),
+                                                           self.inorder_pos.tolist(),
+                                                           self.depth.tolist(),
+                                                           self.axis[:self.size].tolist())
+        ]
+    # Every dictionary exists already, so the children can be linked without recursion
+        for row, (l, r) in enumerate(zip(self.left[:self.size].tolist(), self.right[:self.size].tolist())):
+            if l != NO_CHILD:
+                dicts[row]["left"] = dicts[l]
+            if r != NO_CHILD:
+                dicts[row]["right"] = dicts[r]
+    # A leaf bucket lists the rest of its points under "bucket"
+        for row in np.nonzero(self.bucket[:self.size] > 1)[0].tolist():
+            dicts[row]["bucket"] = self.coords[row + 1:row + int(self.bucket[row])].tolist()
+        return dicts[self.root]
+
+    def save(self, path):
+        """
+        Writes the tree to a single binary file: MAGIC, the length of a JSON header, the header (sizes and
+        the dtype, shape and offset of every array) and then the used rows of every array, each starting at
+        a multiple of ALIGNMENT bytes so load can memory map them in place
+
+        Args:
+            path (str): the file to write
+        """
+        arrays = {
+            "coords": self.coords[:self.size],
+            "left": self.left[:self.size],
+            "right": self.right[:self.size],
+            "axis": self.axis[:self.size],
+            "bucket": self.bucket[:self.size]
+        }
+        if self.ids is not None:
+            arrays["ids"] = self.ids[:self.size]
+        if self.counts is not None:
+            arrays["counts"] = self.counts[:self.size]
+        for name, column in self.columns.items():
+            if column.dtype.hasobject:
+                raise ValueError(f"Column {name!r} holds Python objects, which can not be saved")
+            arrays["columns/" + name] = column
+    # Offsets are counted from the end of the header, so they do not depend on the header's own length
+        entries = {}
+        offset = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            arrays[name] = array
+            entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        header = json.dumps({
+            "size": self.size,
+            "root": int(self.root),
+            "next_id": self.next_id,
+            "min_overall_val": None if self.min_overall_val is None else float(self.min_overall_val),
+            "max_overall_val": None if self.max_overall_val is None else float(self.max_overall_val),
+            "arrays": entries
+        }).encode()
+        start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).astype('<u8').tobytes())
+            f.write(header)
+            for name, array in arrays.items():
+                f.write(b"\0" * (start + entries[name]["offset"] - f.tell()))
+                f.write(array.tobytes())
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        """
+        Opens a file written by save, with mmap the arrays are read only np.memmap views of the file,
+        so opening takes about the same time for any size of tree and every process that opens the same file
+        shares one copy of it in the page cache. Without mmap the arrays are read into memory and the tree
+        can still be added to
+
+        Args:
+            path (str): the file to open
+            mmap (bool): whether to memory map the arrays instead of reading them
+
+        Returns:
+            FlatKDTree: the saved tree
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a saved FlatKDTree")
+            length = int(np.frombuffer(f.read(8), dtype = '<u8')[0])
+            header = json.loads(f.read(length))
+        start = -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+
+        arrays = {}
+        for name, entry in header["arrays"].items():
+            shape = tuple(entry["shape"])
+            if 0 in shape:
+            # np.memmap can not map zero bytes
+                array = np.empty(shape, dtype = entry["dtype"])
+            else:
+                array = np.memmap(path, dtype = entry["dtype"], mode = 'r', offset = start + entry["offset"], shape = shape)
+            arrays[name] = array if mmap else np.array(array)
+
+        tree = cls()
+    # add writes into the arrays, so an empty tree keeps the empty arrays it starts with to grow into
+        if header["size"]:
+            tree.coords = arrays["coords"]
+            tree.left = arrays["left"]
+            tree.right = arrays["right"]
+            tree.axis = arrays["axis"]
+            tree.bucket = arrays["bucket"]
+            tree.ids = arrays.get("ids")
+            tree.counts = arrays.get("counts")
+        tree.columns = {name[len("columns/"):]: array for name, array in arrays.items() if name.startswith("columns/")}
+        tree.size = header["size"]
+        tree.root = header["root"]
+        tree.next_id = header["next_id"]
+        tree.min_overall_val = header["min_overall_val"]
+        tree.max_overall_val = header["max_overall_val"]
+        return tree
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from flat_tree import FlatKDTree
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_knn_batch_matches_brute_force(seed):
+# Small integer grids give many ties, which is where the bound of a query sits exactly on a point
+    rng = np.random.default_rng(seed)
+    points = rng.integers(0, 20, (int(rng.integers(5, 300)), 3)).astype(float)
+    tree = FlatKDTree.from_points(points, leaf_size = int(rng.choice([1, 4, 16])))
+    centers = np.concatenate([points[rng.integers(0, len(points), 25)], rng.uniform(-5, 25, (25, 3))])
+    k = int(rng.integers(1, 12))
+
+    offsets, indices, distances = tree.knn_batch(centers, k)
+
+    assert offsets[-1] == len(indices) == len(distances)
+    assert np.all(np.diff(offsets) == min(k, len(points)))
+    for i, center in enumerate(centers):
+        found = slice(offsets[i], offsets[i + 1])
+        expected = np.sort(np.linalg.norm(points - center, axis = 1))[:min(k, len(points))]
+        np.testing.assert_allclose(distances[found], expected)
+        np.testing.assert_allclose(np.linalg.norm(points[indices[found]] - center, axis = 1), distances[found])
+
+
+def test_sphere_neighbors_batch_negative_radius_is_empty():
+    points = np.random.default_rng(0).uniform(0, 10, (100, 3))
+    tree = FlatKDTree.from_points(points)
+
+    offsets, indices = tree.sphere_neighbors_batch([[5, 5, 5], [5, 5, 5]], [-5, 5])
+
+    assert offsets[1] == 0
+    assert offsets[2] == np.sum(np.linalg.norm(points - 5, axis = 1) <= 5)
+    assert len(indices) == offsets[2]
+
+
+def test_add_widens_the_overall_values_and_knn_batch_still_matches():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 10, (200, 3))
+    tree = FlatKDTree.from_points(points)
+    far = rng.uniform(500, 1000, (50, 3))
+    for point in far:
+        tree.add(*point)
+    everything = np.concatenate([points, far])
+
+    assert tree.min_overall_val <= everything.min()
+    assert tree.max_overall_val >= everything.max()
+    offsets, indices, distances = tree.knn_batch(far + 1, 3)
+    for i, center in enumerate(far + 1):
+        expected = np.sort(np.linalg.norm(everything - center, axis = 1))[:3]
+        np.testing.assert_allclose(distances[offsets[i]:offsets[i + 1]], expected)
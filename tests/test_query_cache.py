@@ -0,0 +1,59 @@
+import numpy as np
+
+from flat_tree import FlatKDTree
+from tree import KDTree, QueryCache
+
+
+def test_repeated_query_is_a_hit():
+    tree = KDTree(cache_size = 8)
+    for point in [(50, 50, 50), (25, 25, 25), (75, 75, 75)]:
+        tree.add(*point)
+
+    first = tree.find_sphere_neighbors(50, 50, 50, 40)
+
+    assert tree.find_sphere_neighbors(50, 50, 50, 40) is first
+    assert tree.query_cache.stats()["hits"] == 1
+
+
+def test_add_and_remove_make_the_next_query_a_miss():
+    tree = KDTree(cache_size = 8)
+    for point in [(50, 50, 50), (25, 25, 25), (75, 75, 75)]:
+        tree.add(*point)
+    assert tree.find_sphere_neighbors(50, 50, 50, 10)[0] == []
+    assert not tree.find(55, 50, 50)[0]
+
+    tree.add(55, 50, 50)
+    hits = tree.query_cache.hits
+    assert tree.find_sphere_neighbors(50, 50, 50, 10)[0] == [(55, 50, 50)]
+    assert tree.find(55, 50, 50)[0]
+    assert tree.query_cache.hits == hits
+
+    tree.remove(55, 50, 50)
+    assert tree.find_sphere_neighbors(50, 50, 50, 10)[0] == []
+    assert not tree.find(55, 50, 50)[0]
+
+    tree.add(55, 50, 50)
+    tree.remove_many([(55, 50, 50)])
+    assert tree.find_sphere_neighbors(50, 50, 50, 10)[0] == []
+
+
+def test_flat_tree_add_makes_the_next_query_a_miss():
+    tree = FlatKDTree.from_points(np.array([(50, 50, 50), (25, 25, 25), (75, 75, 75)], dtype = float))
+    tree.query_cache = QueryCache()
+    before = tree.find_sphere_neighbors(50, 50, 50, 10)
+
+    tree.add(55, 50, 50)
+
+    assert before[0] == []
+    assert tree.find_sphere_neighbors(50, 50, 50, 10)[0] == [(55, 50, 50)]
+
+
+def test_capacity_evicts_the_least_recently_used_result():
+    cache = QueryCache(2)
+    cache.get_or_compute("a", lambda: 1)
+    cache.get_or_compute("b", lambda: 2)
+    cache.get_or_compute("a", lambda: None)
+    cache.get_or_compute("c", lambda: 3)
+
+    assert "a" in cache and "c" in cache and "b" not in cache
+    assert cache.stats() == {"hits": 1, "misses": 3, "hit_rate": 0.25, "entries": 2}
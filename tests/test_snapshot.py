@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from flat_tree import FlatKDTree
+from tree import KDTree
+
+
+def make_tree(seed):
+# Repeated points, tombstones and payload columns of a few dtypes and shapes
+    rng = np.random.default_rng(seed)
+    points = rng.integers(0, 12, (400, 3)).astype(float)
+    tree = KDTree.from_points(points, weight = rng.uniform(0, 1, 400), label = rng.integers(0, 100, 400).astype(np.int16),
+                              normal = rng.uniform(-1, 1, (400, 3)))
+    tree.remove_many(points[rng.choice(400, 120, replace = False)].tolist())
+    tree.add(20, 20, 20, weight = 0.5, label = 7, normal = (0, 0, 1))
+    return tree, rng
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_mmap_load_answers_like_the_saved_tree(seed, tmp_path):
+    tree, rng = make_tree(seed)
+    path = str(tmp_path / "tree.kdtree")
+    tree.save(path)
+
+    flat = KDTree.load(path)
+
+    assert isinstance(flat, FlatKDTree)
+    assert isinstance(flat.coords, np.memmap)
+    assert flat.next_id == tree.next_id
+    for name in ("coords", "weight", "label", "normal"):
+        np.testing.assert_array_equal(flat.columns[name], tree.column(name))
+        assert flat.columns[name].dtype == tree.column(name).dtype
+    for center in rng.integers(0, 12, (10, 3)).astype(float).tolist():
+        assert flat.find(*center)[0] == tree.find(*center)[0]
+        assert flat.find_sphere_neighbors(*center, 3)[:2] == tree.find_sphere_neighbors(*center, 3)[:2]
+        offsets, ids = flat.sphere_neighbors_batch([center], 3)
+        assert sorted(map(tuple, flat.columns["coords"][ids].tolist())) == sorted(
+            tree.sphere_neighbors(*center, 3) + ([tuple(center)] if tree.find(*center)[0] else []))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_load_without_mmap_gives_a_tree_that_can_change(seed, tmp_path):
+    tree, rng = make_tree(seed)
+    path = str(tmp_path / "tree.kdtree")
+    tree.save(path)
+
+    loaded = KDTree.load(path, mmap = False)
+
+    assert isinstance(loaded, KDTree)
+    assert loaded.root.total == tree.root.total
+    for name in ("coords", "weight", "label", "normal"):
+        np.testing.assert_array_equal(loaded.column(name), tree.column(name))
+    for center in rng.integers(0, 12, (10, 3)).astype(float).tolist():
+        assert loaded.find_sphere_neighbors(*center, 3)[:2] == tree.find_sphere_neighbors(*center, 3)[:2]
+        assert loaded.count_sphere(*center, 3) == tree.count_sphere(*center, 3)
+        assert loaded.knn(*center, 4)[1] == pytest.approx(tree.knn(*center, 4)[1])
+        ids = loaded.range_query(((0, center[0]), (0, center[1]), (0, center[2])), ids = True)
+        assert sorted(map(tuple, loaded.column("coords")[ids].tolist())) == sorted(
+            tree.range_query(((0, center[0]), (0, center[1]), (0, center[2]))))
+
+    point_id = loaded.add(30, 30, 30, weight = 1.0)
+    assert point_id == tree.next_id
+    assert loaded.find(30, 30, 30)[0]
+    assert loaded.column("weight")[point_id] == 1.0
+
+
+def test_empty_tree_round_trips(tmp_path):
+    path = str(tmp_path / "empty.kdtree")
+    KDTree().save(path)
+
+    assert len(KDTree.load(path)) == 0
+    assert KDTree.load(path, mmap = False).root is None
+
+
+def test_object_columns_can_not_be_saved(tmp_path):
+    tree = KDTree.from_points([(0, 0, 0), (1, 1, 1)], label = ['a', 'b'])
+
+    with pytest.raises(ValueError):
+        tree.save(str(tmp_path / "tree.kdtree"))
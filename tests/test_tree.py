@@ -0,0 +1,176 @@
+import math
+import numpy as np
+import pytest
+
+from tree import KDTree
+
+
+@pytest.mark.parametrize("trace", [False, True])
+def test_find_sphere_neighbors_negative_radius_is_empty(trace):
+    tree = KDTree.from_points([(0, 0, 0), (1, 1, 1), (3, 3, 3)])
+
+    neighbors, found, _, _ = tree.find_sphere_neighbors(0, 0, 0, -2, trace = trace)
+
+    assert neighbors == []
+    assert found
+    assert tree.sphere_neighbors(0, 0, 0, -2) == []
+    assert tree.count_sphere(0, 0, 0, -2) == 0
+
+
+def test_from_points_string_column_keeps_longer_strings_added_later():
+    tree = KDTree.from_points([(0, 0, 0), (1, 1, 1)], label = ['ab', 'cd'])
+
+    point_id = tree.add(5, 5, 5, label = 'a much longer label')
+
+    assert list(tree.column("label")) == ['ab', 'cd', 'a much longer label']
+    assert tree.column("label")[point_id] == 'a much longer label'
+
+
+def check_against_brute_force(tree, model, rng):
+# Compares every query of the tree with the same query done by hand on model, a {point: copies} dict
+    points = np.array(sorted(model), dtype = float).reshape(-1, 3)
+    copies = np.array([model[point] for point in sorted(model)], dtype = np.int64)
+    for center in rng.integers(-2, 18, (6, 3)).astype(float).tolist():
+        a, b, c = center
+        r = float(rng.uniform(0, 8))
+        distances = np.linalg.norm(points - center, axis = 1)
+        inside = [tuple(point) for point in points[(distances <= r) & (distances > 0)].tolist()]
+
+        assert tree.find(a, b, c)[0] == (tuple(center) in model)
+        neighbors, found, _, _ = tree.find_sphere_neighbors(a, b, c, r)
+        assert neighbors == inside
+        assert found == (tuple(center) in model)
+        assert sorted(tree.sphere_neighbors(a, b, c, r)) == inside
+        assert tree.count_sphere(a, b, c, r) == copies[distances <= r].sum()
+
+        low = np.minimum(center, rng.integers(-2, 18, 3))
+        high = np.maximum(center, rng.integers(-2, 18, 3))
+        box = tuple(zip(low.tolist(), high.tolist()))
+        in_box = np.all((points >= low) & (points <= high), axis = 1)
+        assert sorted(tree.range_query(box)) == [tuple(point) for point in points[in_box].tolist()]
+        assert tree.count_box(box) == copies[in_box].sum()
+
+        k = int(rng.integers(1, 8))
+        nearest, nearest_distances = tree.knn(a, b, c, k)
+        np.testing.assert_allclose(nearest_distances, np.sort(distances)[:k])
+        np.testing.assert_allclose(np.linalg.norm(np.array(nearest).reshape(-1, 3) - center, axis = 1), nearest_distances)
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_add_remove_churn_matches_brute_force(seed):
+# A small integer grid, so points get added again, removed while they still have copies and removed when absent
+    rng = np.random.default_rng(seed)
+    start = rng.integers(0, 16, (int(rng.integers(0, 60)), 3)).astype(float)
+    tree = KDTree.from_points(start) if len(start) else KDTree(alpha = rng.choice([None, 0.7]))
+    model = {}
+    for point in map(tuple, start.tolist()):
+        model[point] = model.get(point, 0) + 1
+
+    for _ in range(8):
+        for _ in range(int(rng.integers(0, 40))):
+            point = tuple(rng.integers(0, 16, 3).astype(float).tolist())
+            if rng.random() < 0.55:
+                tree.add(*point)
+                model[point] = model.get(point, 0) + 1
+            else:
+                assert tree.remove(*point) == (point in model)
+                if point in model:
+                    model[point] -= 1
+                    if not model[point]:
+                        del model[point]
+        batch = [tuple(point) for point in rng.integers(0, 16, (int(rng.integers(0, 30)), 3)).astype(float).tolist()]
+        batch += list(model)[:int(rng.integers(0, len(model) + 1))]
+        removed = 0
+        for point in batch:
+            if point in model:
+                removed += 1
+                model[point] -= 1
+                if not model[point]:
+                    del model[point]
+        assert tree.remove_many(batch) == removed
+        check_against_brute_force(tree, model, rng)
+
+
+def height(node):
+    best = 0
+    stack = [(node, 1)] if node else []
+    while stack:
+        node, depth = stack.pop()
+        best = max(best, depth)
+        stack.extend((child, depth + 1) for child in (node.left, node.right) if child)
+    return best
+
+
+@pytest.mark.parametrize("alpha", [0.6, 0.7, 0.8])
+@pytest.mark.parametrize("order", ["diagonal", "reversed diagonal", "x sorted", "x zigzag"])
+def test_alpha_keeps_depth_logarithmic_under_sorted_inserts(alpha, order):
+# Distinct values on every axis: a node can only be split evenly when the points don't all tie with it,
+# since ties always go right
+    n = 2000
+    rng = np.random.default_rng(0)
+    y, z = rng.permutation(n), rng.permutation(n)
+    points = {
+        "diagonal": [(i, i, i) for i in range(n)],
+        "reversed diagonal": [(n - i, n - i, n - i) for i in range(n)],
+        "x sorted": [(i, y[i], z[i]) for i in range(n)],
+        "x zigzag": [(i // 2 if i % 2 else n - i // 2, y[i], z[i]) for i in range(n)]
+    }[order]
+    tree = KDTree(alpha = alpha)
+    for point in points:
+        tree.add(*point)
+
+    assert height(tree.root) <= math.log(n) / math.log(1 / alpha) + 2
+    assert tree.root.size == n
+    assert all(tree.find(*point)[0] for point in points[::97])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_repeated_points_are_counted_once_per_node_with_stable_ids(seed):
+    rng = np.random.default_rng(seed)
+    points = rng.integers(0, 6, (300, 3)).astype(float)
+    distinct = np.unique(points, axis = 0)
+    bulk = KDTree.from_points(points)
+    incremental = KDTree(alpha = 0.7 if seed % 2 else None)
+    first_ids = {}
+    for point in map(tuple, points.tolist()):
+        point_id = incremental.add(*point)
+    # A point that is already in the tree keeps the id it got the first time
+        assert first_ids.setdefault(point, point_id) == point_id
+
+    for tree in (bulk, incremental):
+        assert tree.root.size == len(distinct)
+        assert tree.root.total == len(points)
+        assert all(tree.find(*point)[0] for point in distinct.tolist())
+        assert tree.count_box(((0, 5), (0, 5), (0, 5))) == len(points)
+
+        coords = tree.column("coords")
+        box = ((1, 4), (0, 3), (2, 5))
+        assert sorted(map(tuple, coords[tree.range_query(box, ids = True)].tolist())) == sorted(tree.range_query(box))
+        center = distinct[0].tolist()
+        assert sorted(map(tuple, coords[tree.sphere_neighbors(*center, 2.5, ids = True)].tolist())) == sorted(tree.sphere_neighbors(*center, 2.5))
+    # Points at the same distance can come in either order, so the ids are checked by their distances
+        nearest_ids, distances = tree.knn(*center, 5, ids = True)
+        assert len(set(nearest_ids.tolist())) == len(nearest_ids)
+        np.testing.assert_allclose(np.linalg.norm(coords[nearest_ids] - center, axis = 1), distances)
+        np.testing.assert_allclose(tree.knn(*center, 5)[1], distances)
+
+    # Taking off every copy but one leaves the point in, taking the last one off removes it
+    point = tuple(distinct[0].tolist())
+    copies = int(np.all(points == distinct[0], axis = 1).sum())
+    for _ in range(copies - 1):
+        assert incremental.remove(*point)
+    assert incremental.find(*point)[0]
+    assert incremental.remove(*point)
+    assert not incremental.find(*point)[0]
+    assert not incremental.remove(*point)
+    assert incremental.root.total == len(points) - copies
+
+
+def test_points_tying_with_a_node_on_its_axis_are_all_kept():
+    tree = KDTree()
+    points = [(50, 50, 50), (50, 10, 10), (50, 90, 90), (50, 50, 10), (50, 50, 90), (10, 50, 50)]
+    for point in points:
+        tree.add(*point)
+
+    assert all(tree.find(*point)[0] for point in points)
+    assert tree.count_box(((50, 50), (0, 100), (0, 100))) == 5
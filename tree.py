@@ -1,9 +1,13 @@
 import math
 import json
+import base64
+import heapq
+import functools
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 
+from collections import OrderedDict
 from dash import dcc
 
 # Necessary Global Variables, LEVEL variables are self explanatory for the coordinates
@@ -13,60 +17,745 @@ Z_LEVEL = 'Z'
 
 
 LEVEL_DICT = {'X': 0, 'Y': 1, 'Z': 2}
+# The level of a node at a given depth cycles through X, Y and Z
+LEVELS = (X_LEVEL, Y_LEVEL, Z_LEVEL)
 
 # This is for the minimum and maximum overall value to get some space
 EPSILON = 10
 
+# A subtree is rebuilt from its remaining points once more than this share of its nodes are removed (tombstoned) ones
+TOMBSTONE_RATIO = 0.5
+
+# Subtrees up to this many points are built in plain Python, for small ones the NumPy calls cost more than they save
+SMALL_BUILD = 256
+
+# Number of rows the id-indexed columns start with, they double in size whenever they fill up
+INITIAL_COLUMN_CAPACITY = 16
+
+# Number of query results a QueryCache keeps before it evicts the least recently used one
+QUERY_CACHE_SIZE = 128
+
+# Colorscale of the barriers of each level, the barriers of deeper nodes get lighter colors
+BARRIER_COLORSCALES = {X_LEVEL: "Reds", Y_LEVEL: "Greens", Z_LEVEL: "Teal"}
+
+
+def narrowest(array, dtypes):
+    """
+    Picks the first of the dtypes that holds every value of the array exactly
+
+    Args:
+        array (np.ndarray): the values to store
+        dtypes (tuple): dtypes to try, from the smallest to the largest (which is used if none of the others fit)
+
+    Returns:
+        np.ndarray: the array converted to that dtype
+    """
+    for dtype in dtypes[:-1]:
+        with np.errstate(invalid = 'ignore', over = 'ignore'):
+            converted = array.astype(dtype)
+        if np.array_equal(converted, array):
+            return converted
+    return array.astype(dtypes[-1])
+
+
+def cached_query(method):
+    """
+    Decorator for the query methods of the trees: when the tree has a query_cache, a call is looked up there by
+    the tree's version, the method and its arguments and only computed the first time. Every change to the tree
+    bumps its version, so results from before the change are never given back (they just age out of the cache)
+
+    Args:
+        method (function): the query method
+
+    Returns:
+        function: the method, answering from the cache when there is one
+    """
+    @functools.wraps(method)
+    def cached(self, *args, **kwargs):
+        cache = self.query_cache
+        if cache is None:
+            return method(self, *args, **kwargs)
+        key = (self.version, method.__name__, args, tuple(sorted(kwargs.items())))
+        return cache.get_or_compute(key, lambda: method(self, *args, **kwargs))
+    return cached
+
+def barrier_meshes(nodes, indexes, cells):
+    """
+    Creates the "barriers", the plane through every node perpendicular to its level's axis that outlines the division
+    between values smaller and larger than it, reaching across the node's cell. The barriers of each level are merged into
+    one Mesh3d trace, every barrier is two triangles colored by the depth of its node (one intensity per triangle),
+    so the 3D plot has at most three traces for the barriers however big the tree is
+
+    Args:
+        nodes (list): the nodes to create barriers for
+        indexes (list): how many levels below the root each node is
+        cells (np.ndarray): (N, 2, 3) array with the low and high corner of every node's cell
+
+    Returns:
+        list: the go.Mesh3d traces for the X, Y and Z barriers that exist
+    """
+    levels = np.array([LEVEL_DICT[node.level] for node in nodes], dtype = np.int64)
+    indexes = np.asarray(indexes, dtype = float)
+    coords = np.array([(node.x, node.y, node.z) for node in nodes], dtype = float).reshape(-1, 3)
+    deepest = max(indexes.max(initial = 0), 1)
+# When the cells were cut down to a smaller box (see KDTree.draw) some barriers are left outside of it
+    rows = np.arange(len(nodes))
+    splits = coords[rows, levels]
+    inside = (np.all(cells[:, 0] <= cells[:, 1], axis = 1) &
+              (cells[rows, 0, levels] <= splits) & (splits <= cells[rows, 1, levels]))
+    meshes = []
+    for axis, level in enumerate(LEVELS):
+        chosen = np.nonzero((levels == axis) & inside)[0]
+        if not len(chosen):
+            continue
+        low, high = cells[chosen, 0], cells[chosen, 1]
+    # Go around the plane through each node, keeping the node's own value on its level's axis
+        vertices = np.empty((len(chosen), 4, 3))
+        vertices[:, :, axis] = coords[chosen, axis, None]
+        a, b = [other for other in range(3) if other != axis]
+        vertices[:, :, a] = np.column_stack((low[:, a], high[:, a], high[:, a], low[:, a]))
+        vertices[:, :, b] = np.column_stack((low[:, b], low[:, b], high[:, b], high[:, b]))
+        vertices = vertices.reshape(-1, 3)
+        first = 4 * np.arange(len(chosen))
+    # The two triangles of a barrier share the diagonal from its first to its third corner
+        i = np.repeat(first, 2)
+        j = np.column_stack((first + 1, first + 2)).ravel()
+        k = np.column_stack((first + 2, first + 3)).ravel()
+        shade = 1 - 0.65 * indexes[chosen] / deepest
+        meshes.append(go.Mesh3d(
+            x = vertices[:, 0],
+            y = vertices[:, 1],
+            z = vertices[:, 2],
+            i = i,
+            j = j,
+            k = k,
+            intensity = np.repeat(shade, 2),
+            intensitymode = 'cell',
+            colorscale = BARRIER_COLORSCALES[level],
+            cmin = 0,
+            cmax = 1,
+        # The name of the node of every barrier, in the same order, the traversal animation uses it to find a barrier
+            meta = [f"{(nodes[n].x, nodes[n].y, nodes[n].z)}" for n in chosen.tolist()],
+            hoverinfo = 'skip',
+            flatshading = True,
+            opacity = 0.5,
+            showscale = False,
+            name = f"{level} barriers"
+        ))
+    return meshes
+
+def median_split(points, start_depth = 0, leaf_size = 1):
+    """
+    Plans a balanced KD Tree over an (N, 3) array by splitting every subtree at the median of its level's axis,
+    without any Python recursion: every level sorts all of its segments at once with one NumPy argsort (of the points'
+    ranks, which are worked out once), so the build is O(n log² n), about 3 s for a million points.
+    Points that tie with the median on the splitting axis always go to the right subtree
+
+    Args:
+        points (np.ndarray): an (N, 3) float array of the x, y and z coordinates
+        start_depth (int): depth of the subtree's root, so the axes continue from an existing tree
+        leaf_size (int): subtrees with at most this many points are not split, the first of their points becomes
+                         a leaf and the rest are put in that leaf's bucket
+
+    Returns:
+        root (int): index of the point that becomes the root, -1 if there are no points
+        left (np.ndarray): index of each point's left child, -1 if there is none
+        right (np.ndarray): index of each point's right child, -1 if there is none
+        depth (np.ndarray): depth of each point in the planned tree
+        owner (np.ndarray): index of the leaf whose bucket holds the point, -1 for the points that are nodes
+    """
+    n = len(points)
+    left = np.full(n, -1, dtype = np.int64)
+    right = np.full(n, -1, dtype = np.int64)
+    depth = np.zeros(n, dtype = np.int64)
+    owner = np.full(n, -1, dtype = np.int64)
+    root = -1
+    order = np.arange(n)
+# Rank the points on every axis once (tied values share a rank) so each level only sorts integers
+    ranks = [np.unique(points[:, axis], return_inverse = True)[1].reshape(-1) for axis in range(3)]
+# Each segment [lo, hi) of order still needs a splitting node, which becomes a child of parent on the given side
+    lo = np.zeros(1, dtype = np.int64)
+    hi = np.full(1, n, dtype = np.int64)
+    parent = np.full(1, -1, dtype = np.int64)
+    is_left = np.zeros(1, dtype = bool)
+    d = start_depth
+    while n and len(lo):
+        sizes = hi - lo
+        starts = np.cumsum(sizes) - sizes
+        seg = np.repeat(np.arange(len(lo)), sizes)
+        pos = np.repeat(lo - starts, sizes) + np.arange(sizes.sum())
+    # Sort every segment by the current axis in one go
+        idx = order[pos]
+        vals = ranks[d % 3][idx]
+        perm = np.argsort(seg * n + vals, kind = 'stable')
+        idx = idx[perm]
+        vals = vals[perm]
+        order[pos] = idx
+    # Take the first point equal to the median so everything tied with it lands on the right
+        k = np.arange(len(idx))
+        new_run = np.ones(len(idx), dtype = bool)
+        new_run[1:] = (seg[1:] != seg[:-1]) | (vals[1:] != vals[:-1])
+        run_start = np.maximum.accumulate(np.where(new_run, k, 0))
+        bucket = sizes <= leaf_size
+        split = np.where(bucket, starts, run_start[starts + sizes // 2])
+        nodes = idx[split]
+        depth[nodes] = d
+    # Small segments become a single leaf holding the rest of the segment in its bucket
+        member = np.repeat(bucket, sizes)
+        member[split] = False
+        owner[idx[member]] = nodes[seg[member]]
+        depth[idx[member]] = d
+    # Hook the new nodes onto their parents
+        linked = parent >= 0
+        left[parent[linked & is_left]] = nodes[linked & is_left]
+        right[parent[linked & ~is_left]] = nodes[linked & ~is_left]
+        if root < 0:
+            root = int(nodes[0])
+    # Whatever is before the split becomes the left segment, whatever is after becomes the right one
+        split_pos = pos[split]
+        lo = np.stack([lo, split_pos + 1], axis = 1).ravel()
+        hi = np.stack([split_pos, hi], axis = 1).ravel()
+        parent = np.repeat(nodes, 2)
+        is_left = np.tile([True, False], len(nodes))
+        keep = (hi > lo) & np.repeat(~bucket, 2)
+        lo, hi, parent, is_left = lo[keep], hi[keep], parent[keep], is_left[keep]
+        d += 1
+    return root, left, right, depth, owner
+
+
+def subtree_bounds(points, left, right, depth, counts = None):
+    """
+    Finds the size and the bounding box of every subtree of a planned tree, working up from the deepest level
+    so each level is merged into its parents with one NumPy call
+
+    Args:
+        points (np.ndarray): an (N, 3) float array of the x, y and z coordinates
+        left (np.ndarray): index of each point's left child, -1 if there is none
+        right (np.ndarray): index of each point's right child, -1 if there is none
+        depth (np.ndarray): depth of each point in the planned tree
+        counts (np.ndarray): how many copies of each point there are, None if every point is there once
+
+    Returns:
+        size (np.ndarray): how many points are in each point's subtree, itself included
+        low (np.ndarray): (N, 3) smallest x, y and z in each point's subtree
+        high (np.ndarray): (N, 3) largest x, y and z in each point's subtree
+        total (np.ndarray): how many copies of points are in each point's subtree
+    """
+    n = len(points)
+    size = np.ones(n, dtype = np.int64)
+    total = size.copy() if counts is None else np.array(counts, dtype = np.int64)
+    low = points.copy()
+    high = points.copy()
+    parent = np.full(n, -1, dtype = np.int64)
+    nodes = np.arange(n)
+    parent[left[left >= 0]] = nodes[left >= 0]
+    parent[right[right >= 0]] = nodes[right >= 0]
+# Deepest level first, so a subtree is complete before it is merged into its parent
+    order = np.argsort(-depth, kind = 'stable')
+    levels = np.flatnonzero(np.diff(depth[order])) + 1
+    for level in np.split(order, levels):
+        level = level[parent[level] >= 0]
+        np.add.at(size, parent[level], size[level])
+        np.add.at(total, parent[level], total[level])
+        np.minimum.at(low, parent[level], low[level])
+        np.maximum.at(high, parent[level], high[level])
+    return size, low, high, total
+
+
+class QueryCache:
+    """
+    LRU of query results, for the KDTree's and FlatKDTree's query_cache (see cached_query) and for anything
+    else worth keeping per query, like the frames of an animation (keyed by the tree's version too).
+    The results are handed out as they are, so they must not be modified by whoever gets them
+    """
+    def __init__(self, capacity = QUERY_CACHE_SIZE):
+        """
+        Args:
+            capacity (int): most results to keep at once
+        """
+        if capacity < 1:
+            raise ValueError(f"capacity has to be at least 1, got {capacity}")
+        self.capacity = capacity
+    # key -> result, ordered from the least to the most recently used
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get_or_compute(self, key, compute):
+        """
+        Args:
+            key (hashable): what identifies the result, a key that can't be hashed is computed every time
+            compute (callable): called without arguments to get the result when it is not kept yet
+
+        Returns:
+            the kept result for the key, or the one compute just gave back
+        """
+        try:
+            result = self.entries[key]
+        except KeyError:
+            pass
+        except TypeError:
+            self.misses += 1
+            return compute()
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return result
+        self.misses += 1
+        result = compute()
+        self.entries[key] = result
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+        return result
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """
+        Returns:
+            dict: the hits, misses, hit rate and number of entries of the cache
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries)
+        }
+
 
 class KDTree:
-    def __init__(self):
+    def __init__(self, alpha = None, cache_size = None):
         self.root = None
+    # With alpha set (between 0.5 and 1), add rebuilds any subtree where one side holds more than alpha of the nodes,
+    # which keeps the depth around log(n) / log(1 / alpha) whatever order the points come in
+        if alpha is not None and not 0.5 < alpha < 1:
+            raise ValueError(f"alpha has to be between 0.5 and 1, got {alpha}")
+        self.alpha = alpha
         self.barriers = None
         self.list = []
         self.min_overall_val = None
         self.max_overall_val = None
+    # The inorder positions and depths of the nodes (and self.list) are only recomputed after the tree changes
+        self.layout_valid = False
+    # Every point gets an integer id, the "coords" column and any payload columns are NumPy arrays indexed by it
+    # (with some unused capacity at the end, column() trims it off)
+        self.next_id = 0
+        self.columns = {}
+    # Bumped by every change, so the results in the query cache (if cache_size is given) are only reused
+    # for the tree they were computed on
+        self.version = 0
+        self.query_cache = QueryCache(cache_size) if cache_size else None
 
-    def add(self, x, y, z):
+    def add(self, x, y, z, **payload):
         """
-        Adds Node to the KD Tree
+        Adds Node to the KD Tree, when the tree has an alpha the biggest subtree that got too lopsided
+        is rebuilt (like a scapegoat tree)
 
         Args:
             x (float): an x-coordinate of the node to be added
             y (float): an y-coordinate of the node to be added
             z (float): an z-coordinate of the node to be added
+            **payload: values to store in the columns of the same name for this point
+
+        Returns:
+            int: the id of the point, a point that is already in the tree keeps its id (and gets the new payload)
         """
         if self.root:
-            self.root.add(x,y,z)
+            node, scapegoat = self.root.add(x,y,z, self.alpha, self.next_id)
+            if scapegoat:
+                self.rebuild(scapegoat)
+            point_id = node.id
+        # Keep the min and max overall values around every point
+            self.min_overall_val = min(self.min_overall_val, min(x,y,z) - EPSILON)
+            self.max_overall_val = max(self.max_overall_val, max(x,y,z) + EPSILON)
         else:
-            self.root = KDNode(x,y,z, X_LEVEL)
+            point_id = self.next_id
+            self.root = KDNode(x,y,z, X_LEVEL, point_id = point_id)
         # Set the Initial min and max overall values to the root's values
             self.min_overall_val = min(x,y,z) - EPSILON
             self.max_overall_val = max(x,y,z) + EPSILON
-        
-    def find(self, x, y, z):
+        if point_id == self.next_id:
+            self.next_id += 1
+            self.store(point_id, coords = (float(x), float(y), float(z)))
+        if payload:
+            if "coords" in payload:
+                raise ValueError("coords is the column of the coordinates, it can't be a payload")
+            self.store(point_id, **payload)
+        self.layout_valid = False
+        self.version += 1
+        return point_id
+
+    def store(self, point_id, **values):
+        """
+        Writes one row of the columns, a new column is made (filled with zeros) the first time its name shows up
+
+        Args:
+            point_id (int): the row to write
+            **values: the value for each column
+        """
+        capacity = len(self.columns["coords"]) if self.columns else 0
+        if point_id >= capacity:
+            capacity = max(2 * capacity, point_id + 1, INITIAL_COLUMN_CAPACITY)
+            for name, column in self.columns.items():
+                grown = np.zeros((capacity,) + column.shape[1:], dtype = column.dtype)
+                grown[:len(column)] = column
+                self.columns[name] = grown
+        for name, value in values.items():
+            if name not in self.columns:
+                sample = np.asarray(value)
+            # Strings get an object column, a fixed width one would cut off longer strings later on
+                dtype = object if sample.dtype.kind in 'US' else sample.dtype
+                self.columns[name] = np.zeros((capacity,) + sample.shape, dtype = dtype)
+            self.columns[name][point_id] = value
+
+    def column(self, name):
+        """
+        Args:
+            name (str): "coords" or the name of a payload column
+
+        Returns:
+            np.ndarray: the column's value for every id, so column(name)[ids] works on the ids the queries return
+        """
+        return self.columns[name][:self.next_id]
+
+    def layout(self):
+        """
+        Makes sure every node's inorder_pos and depth are up to date, they only have to be recomputed after
+        the tree has changed, so repeated finds and exports skip the two full walks of the tree
+
+        Returns:
+            list: the (x,y,z) coordinates of every node in inorder
+        """
+        if not self.layout_valid:
+            self.list = []
+            if self.root:
+                self.root.inorder([0], self.list)
+                self.root.find_depths(0)
+            self.layout_valid = True
+        return self.list
+
+    @classmethod
+    def from_points(cls, points, **columns):
+        """
+        Builds a balanced KD Tree from many points at once by splitting on the median of each level,
+        unlike adding the points one by one the shape does not depend on the order of the points,
+        so the depth stays around log2(N) even for sorted or clustered input.
+        Making one KDNode per point is most of the time this takes (about 15 s for a million points),
+        FlatKDTree.from_points builds the same tree in arrays in about a fifth of that, use it for bulk loads
+        that only need to be queried
+
+        Args:
+            points (np.ndarray or iterable): an (N, 3) array or any iterable of (x, y, z) triples
+            **columns: payload arrays with one value per point, the id of every point is its row in points
+
+        Returns:
+            KDTree: the balanced tree containing every point
+        """
+        points = np.asarray(points if isinstance(points, np.ndarray) else list(points), dtype = float)
+        if points.size == 0:
+            return cls()
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError(f"Expected an (N, 3) array of points, got shape {points.shape}")
+        columns = {name: np.array(column) for name, column in columns.items()}
+        for name, column in columns.items():
+        # Strings get an object column like in store, a fixed width one would cut off longer strings added later on
+            if column.dtype.kind in 'US':
+                columns[name] = column = column.astype(object)
+            if name == "coords" or len(column) != len(points):
+                raise ValueError(f"Expected the column {name} to have one value per point, got {len(column)} for {len(points)} points")
+
+        tree = cls()
+        tree.columns = {"coords": points.copy(), **columns}
+        tree.next_id = len(points)
+    # Repeated points are stored once, with a count (and the id of their first row)
+        unique, ids, counts = np.unique(points, axis = 0, return_index = True, return_counts = True)
+        tree.root = cls.build(unique, counts = counts if len(unique) < len(points) else None, ids = ids)
+        tree.min_overall_val = points.min() - EPSILON
+        tree.max_overall_val = points.max() + EPSILON
+        return tree
+
+    def save(self, path):
+        """
+        Writes the tree to a single binary file in the flat layout of FlatKDTree.save (coordinates, child rows,
+        axes, ids, counts and the payload columns), keeping the shape of the tree
+
+        Args:
+            path (str): the file to write
         """
-        Finds if the target node is in the Tree, records the path to the target node,
+        from flat_tree import FlatKDTree
+        flat = FlatKDTree.from_tree(self)
+        flat.columns = {name: column[:self.next_id] for name, column in self.columns.items()}
+        flat.save(path)
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        """
+        Opens a file written by save (or FlatKDTree.save). With mmap it returns the FlatKDTree over read only
+        memory maps of the file, which answers the same queries without building any KDNodes, so a worker
+        process can open a large tree in milliseconds and share the page cache with every other worker.
+        Without mmap the points are read and built into a balanced KDTree that can be changed again
+
+        Args:
+            path (str): the file to open
+            mmap (bool): whether to return the memory mapped FlatKDTree instead of building a KDTree
+
+        Returns:
+            FlatKDTree or KDTree: the saved tree
+        """
+        from flat_tree import FlatKDTree
+        flat = FlatKDTree.load(path, mmap = mmap)
+        if mmap:
+            return flat
+
+        tree = cls()
+        tree.next_id = flat.next_id
+        tree.columns = dict(flat.columns)
+        if flat.size:
+            points = flat.coords[:flat.size]
+            ids = flat._to_ids(np.arange(flat.size))
+            counts = np.ones(flat.size, dtype = np.int64) if flat.counts is None else flat.counts[:flat.size]
+            if "coords" not in tree.columns:
+                tree.columns["coords"] = np.zeros((tree.next_id, 3))
+                tree.columns["coords"][ids] = points
+        # A FlatKDTree keeps a repeated point in a row of its own, here it becomes a single node with a count
+            unique, first, inverse = np.unique(points, axis = 0, return_index = True, return_inverse = True)
+            counts = np.bincount(inverse.ravel(), weights = counts, minlength = len(unique)).astype(np.int64)
+            tree.root = cls.build(unique, counts = counts if (counts > 1).any() else None, ids = ids[first])
+            tree.min_overall_val = flat.min_overall_val
+            tree.max_overall_val = flat.max_overall_val
+        return tree
+
+    @staticmethod
+    def build(points, start_depth = 0, counts = None, ids = None):
+        """
+        Builds the KDNodes of a balanced subtree, used by from_points and for rebuilding subtrees,
+        either way the median of each level is the first point equal to it so ties go to the right
+
+        Args:
+            points (np.ndarray or list): an (N, 3) float array or a list of (x, y, z) tuples, with at least one point,
+            no point should be listed twice
+            start_depth (int): depth of the subtree's root, so the levels continue from an existing tree
+            counts (list or np.ndarray): how many copies of each point there are, None if every point is there once
+            ids (list or np.ndarray): the id of each point, None numbers them from 0
+
+        Returns:
+            KDNode: the root of the new subtree
+        """
+        if ids is None:
+            ids = range(len(points))
+        if len(points) <= SMALL_BUILD:
+            points = [tuple(point) for point in points.tolist()] if isinstance(points, np.ndarray) else list(points)
+            counts = counts.tolist() if isinstance(counts, np.ndarray) else counts
+            ids = ids.tolist() if isinstance(ids, np.ndarray) else list(ids)
+            return KDTree.build_small(points, start_depth, counts, ids)
+        points = np.asarray(points, dtype = float)
+        root, left, right, depth, owner = median_split(points, start_depth)
+        size, low, high, total = subtree_bounds(points, left, right, depth, counts)
+    # Create every node first, then link them together using the planned children
+        nodes = [KDNode(x, y, z, LEVELS[d % 3], point_id = i) for (x, y, z), d, i in zip(points.tolist(), depth.tolist(), np.asarray(ids).tolist())]
+        if counts is not None:
+            for node, count in zip(nodes, np.asarray(counts).tolist()):
+                node.count = count
+        for node, l, r, node_size, node_total, node_low, node_high in zip(nodes, left.tolist(), right.tolist(), size.tolist(),
+                                                                        total.tolist(), low.tolist(), high.tolist()):
+            node.size = node_size
+            node.total = node_total
+            node.low = node_low
+            node.high = node_high
+            if l >= 0:
+                node.left = nodes[l]
+                node.left.parent = node
+            if r >= 0:
+                node.right = nodes[r]
+                node.right.parent = node
+        return nodes[root]
+
+    @staticmethod
+    def build_small(points, start_depth = 0, counts = None, ids = None):
+        """
+        The plain Python version of build for a handful of points, every group is sorted on its level's axis and split
+        at the first point equal to its median
+
+        Args:
+            points (list): (x, y, z) tuples, with at least one point and none of them listed twice
+            start_depth (int): depth of the subtree's root, so the levels continue from an existing tree
+            counts (list): how many copies of each point there are, None if every point is there once
+            ids (list): the id of each point, None numbers them from 0
+
+        Returns:
+            KDNode: the root of the new subtree
+        """
+        nodes = []
+        items = list(zip(points, counts if counts is not None else [1] * len(points), ids if ids is not None else range(len(points))))
+        stack = [(items, start_depth % 3, None, False)]
+        while stack:
+            group, axis, parent, isLeft = stack.pop()
+            group.sort(key = lambda item: item[0][axis])
+            mid = len(group) // 2
+            value = group[mid][0][axis]
+            while mid and group[mid - 1][0][axis] == value:
+                mid -= 1
+            (x, y, z), count, point_id = group[mid]
+            node = KDNode(x, y, z, LEVELS[axis], parent, point_id)
+            node.count = node.total = count
+            if parent is not None:
+                if isLeft:
+                    parent.left = node
+                else:
+                    parent.right = node
+            nodes.append(node)
+            next_axis = (axis + 1) % 3
+            if mid + 1 < len(group):
+                stack.append((group[mid + 1:], next_axis, node, False))
+            if mid:
+                stack.append((group[:mid], next_axis, node, True))
+    # Parents are created before their children, so going backwards finishes every subtree before its parent
+        for node in reversed(nodes[1:]):
+            parent = node.parent
+            parent.size += node.size
+            parent.total += node.total
+            low, high, node_low, node_high = parent.low, parent.high, node.low, node.high
+            for axis in range(3):
+                low[axis] = min(low[axis], node_low[axis])
+                high[axis] = max(high[axis], node_high[axis])
+        return nodes[0]
+
+    def remove(self, x, y, z):
+        """
+        Removes one copy of a point from the KD Tree, once the last copy is gone the node stays in place as a tombstone
+        that queries skip, the biggest subtree on the way to the root that ends up with too many tombstones is rebuilt
+        from its remaining points
+
+        Args:
+            x (float): an x-coordinate of the node to be removed
+            y (float): an y-coordinate of the node to be removed
+            z (float): an z-coordinate of the node to be removed
+
+        Returns:
+            bool: True if the point was in the tree and got removed, False otherwise
+        """
+        node = self.root.remove(x, y, z) if self.root else None
+        if node is None:
+            return False
+        emptied = node.deleted
+        worst = None
+        while node:
+            node.total -= 1
+            if emptied:
+                node.size -= 1
+                node.dead += 1
+                if node.dead > TOMBSTONE_RATIO * (node.size + node.dead):
+                    worst = node
+            node = node.parent
+        if worst:
+            self.rebuild(worst)
+        self.layout_valid = False
+        self.version += 1
+        return True
+
+    def remove_many(self, points):
+        """
+        Removes many points at once, every point is tombstoned first and the subtrees with too many tombstones
+        are rebuilt in a single pass at the end
+
+        Args:
+            points (iterable): (x, y, z) triples to remove, a point listed twice removes two copies of it
+
+        Returns:
+            int: how many of the points were in the tree and got removed
+        """
+        removed = 0
+        for x, y, z in points:
+            node = self.root.remove(x, y, z) if self.root else None
+            if node is None:
+                continue
+            removed += 1
+            emptied = node.deleted
+            while node:
+                node.total -= 1
+                if emptied:
+                    node.size -= 1
+                    node.dead += 1
+                node = node.parent
+    # Rebuild from the top, so a subtree inside one that gets rebuilt isn't rebuilt by itself first
+        stack = [self.root] if removed and self.root else []
+        while stack:
+            node = stack.pop()
+            if node.dead > TOMBSTONE_RATIO * (node.size + node.dead):
+                self.rebuild(node)
+                continue
+            for child in (node.left, node.right):
+                if child and child.dead:
+                    stack.append(child)
+        if removed:
+            self.layout_valid = False
+            self.version += 1
+        return removed
+
+    def rebuild(self, node):
+        """
+        Replaces a subtree with a balanced one made from its points that aren't tombstones
+
+        Args:
+            node (KDNode): the root of the subtree to rebuild
+        """
+        points = []
+        counts = []
+        ids = []
+        node.points(points, counts, ids)
+        parent = node.parent
+        new_node = self.build(points, LEVEL_DICT[node.level], counts, ids) if points else None
+        if parent is None:
+            self.root = new_node
+        elif parent.left is node:
+            parent.left = new_node
+        else:
+            parent.right = new_node
+        if new_node:
+            new_node.parent = parent
+    # The tombstones are gone now, the ancestors' sizes stay the same since the same points are still there
+        while parent:
+            parent.dead -= node.dead
+            parent = parent.parent
+        self.layout_valid = False
+
+    @cached_query
+    def find(self, x, y, z, trace = False):
+        """
+        Finds if the target node is in the Tree, when tracing it also records the path to the target node,
         along with the distance between the target node and the nodes traversed to the target node using the distance formula
 
         Args:
             x (float): an x-coordinate of the node to be found
             y (float): an y-coordinate of the node to be found
             z (float): an z-coordinate of the node to be found
+            trace (bool): records the path for drawing it, leave it off when only the answer is needed
 
         Returns:
             found (bool): True if the node is found in the tree, False otherwise
             path (dict): keys refer to the intermediary nodes between the root and the target node (2D Tree)
                               values refer to the distance between the intermediary nodes and the target node,
-                              and the (x,y,z) coordinate in the 3D Tree
+                              and the (x,y,z) coordinate in the 3D Tree, empty unless trace is True
         """
     # Setup Structures beforehand...
         path = {}
         found = False
 
         if self.root:
-            self.inorder()
-            self.root.find_depths(0)
-            found = self.root.find(x,y,z, path)
+            if trace:
+            # The path is keyed by the 2D positions, so they have to be up to date
+                self.layout()
+                found = self.root.find(x,y,z, path)
+            else:
+                found = self.root.find(x,y,z)
         else:
             dcc.ConfirmDialog(
                 id = 'no-elements',
@@ -75,182 +764,452 @@ class KDTree:
         
         return found, path
     
-    def find_sphere_neighbors(self, a, b, c, r):
+    @cached_query
+    def find_sphere_neighbors(self, a, b, c, r, trace = False, ids = False):
         """
-        Finds the Sphere's neighbors that are within the sphere by checking if its inside the sphere
+        Finds the Sphere's neighbors that are within the sphere by checking if its inside the sphere,
+        the traversal is only recorded for the animation when trace is True
 
         Args:
             a (float): x-coordinate of the center of the sphere
             b (float): y-coordinate of the center of the sphere
             c (float): z-coordinate of the center of the sphere
             r (float): radius of the sphere
+            trace (bool): records the traversal for the animation
+            ids (bool): return the neighbors as an array of their ids instead of a list of coordinates
 
         Returns:
-            neighbors (list): all the neighbors in the sphere
+            neighbors (list or np.ndarray): all the neighbors in the sphere, sorted
             isCenterFound (bool): True if the center of the sphere is in the tree, False otherwise
-            traversal_coordinates (list): contains a sublist of the 2D Coordinate and 3D Coordinates of traversed neighbors
+            traversal_coordinates (list): contains a sublist of the 2D Coordinate and 3D Coordinates of traversed neighbors,
+            None unless trace is True
             inorder_neighbors (list): if there are no neighbors in the current traversal, it will be None, 
-            otherwise it has the 2D coordinate
+            otherwise it has the 2D coordinate, None unless trace is True
         """
         neighbors = []
-        traversal_coordinates = []
-    # We assume at the first part we do not know if it is in the neighbors yet so we start the first value as None
-        inorder_neighbors = [None]
-    # In Order and find_depths are simply there for Traversing the Tree :)
+        traversal_coordinates = None
+        inorder_neighbors = None
+        isCenterFound = False
         if self.root:
         #Checks if the center of the sphere is in the tree
             isCenterFound, path = self.find(a,b,c)
-            self.root.find_sphere_neighbors(a,b,c,r, neighbors, traversal_coordinates, inorder_neighbors)
+            if trace:
+                traversal_coordinates = []
+            # We assume at the first part we do not know if it is in the neighbors yet so we start the first value as None
+                inorder_neighbors = [None]
+                self.layout()
+
+                def visit(node, inside):
+                    current_point_2D_val = (node.inorder_pos, node.depth)
+                    traversal_coordinates.append([current_point_2D_val, (node.x, node.y, node.z)])
+                    inorder_neighbors.append(current_point_2D_val if inside else None)
+
+                self.root.find_sphere_neighbors(a,b,c,r, neighbors, visit, ids)
+            else:
+            # Without the animation the lean query can prune whole cells
+                self.root.sphere_neighbors(a,b,c,r, neighbors, ids)
             neighbors.sort()
+        elif trace:
+            traversal_coordinates = []
+            inorder_neighbors = [None]
+        if ids:
+            neighbors = np.array(neighbors, dtype = np.int64)
         return neighbors, isCenterFound, traversal_coordinates, inorder_neighbors
- 
-    def inorder(self):
-        key_list = []
+
+    def sphere_neighbors(self, a, b, c, r, ids = False):
+        """
+        Finds the points within the sphere without any of the bookkeeping find_sphere_neighbors does for the animation,
+        use this one when only the neighbors are needed
+
+        Args:
+            a (float): x-coordinate of the center of the sphere
+            b (float): y-coordinate of the center of the sphere
+            c (float): z-coordinate of the center of the sphere
+            r (float): radius of the sphere
+            ids (bool): return an array of the points' ids instead of a list of coordinates
+
+        Returns:
+            list or np.ndarray: the (x,y,z) coordinates (or ids) of the points in the sphere (not counting the center),
+            in no particular order, a repeated point is listed once
+        """
+        neighbors = []
+        if self.root and r >= 0:
+            self.root.sphere_neighbors(a, b, c, r, neighbors, ids)
+        return np.array(neighbors, dtype = np.int64) if ids else neighbors
+
+    def range_query(self, box, ids = False):
+        """
+        Finds every point inside an axis-aligned box, the edges of the box count as inside
+
+        Args:
+            box (tuple): ((x0, x1), (y0, y1), (z0, z1)), the smallest and largest value of the box on every axis
+            ids (bool): return an array of the points' ids instead of a list of coordinates
+
+        Returns:
+            list or np.ndarray: the (x,y,z) coordinates (or ids) of the points in the box, in no particular order,
+            a repeated point is listed once
+        """
+        (x0, x1), (y0, y1), (z0, z1) = box
+        found = []
         if self.root:
-            self.root.inorder([0], key_list)
-        return key_list
+            self.root.range_query(x0, x1, y0, y1, z0, z1, found, ids)
+        return np.array(found, dtype = np.int64) if ids else found
+
+    def count_box(self, box):
+        """
+        Counts the points inside an axis-aligned box without building the list of them, every copy of a repeated point counts
+
+        Args:
+            box (tuple): ((x0, x1), (y0, y1), (z0, z1)), the smallest and largest value of the box on every axis
+
+        Returns:
+            int: how many points are in the box
+        """
+        (x0, x1), (y0, y1), (z0, z1) = box
+        if not self.root:
+            return 0
+        return self.root.count_box(x0, x1, y0, y1, z0, z1)
+
+    def count_sphere(self, a, b, c, r):
+        """
+        Counts the points within the sphere without building the list of them, unlike the neighbor queries
+        a point sitting right on the center is counted as well, and so is every copy of a repeated point
+
+        Args:
+            a (float): x-coordinate of the center of the sphere
+            b (float): y-coordinate of the center of the sphere
+            c (float): z-coordinate of the center of the sphere
+            r (float): radius of the sphere
+
+        Returns:
+            int: how many points are in the sphere
+        """
+        if not self.root or r < 0:
+            return 0
+        return self.root.count_sphere(a, b, c, r)
+
+    def knn(self, x, y, z, k, ids = False):
+        """
+        Finds the k closest points in the tree to (x, y, z), using the same splitting-plane checks as
+        find_sphere_neighbors to skip subtrees that can't hold anything closer
+
+        Args:
+            x (float): x-coordinate of the query point
+            y (float): y-coordinate of the query point
+            z (float): z-coordinate of the query point
+            k (int): how many points to find
+            ids (bool): return an array of the neighbors' ids instead of a list of coordinates
+
+        Returns:
+            neighbors (list or np.ndarray): up to k different (x,y,z) coordinates (or ids), closest first
+            (the query point itself counts if it is in the tree)
+            distances (list): the distance of each of those neighbors to the query point
+        """
+        heap = []
+        if self.root and k > 0:
+            self.root.knn(x, y, z, k, heap, ids)
+    # Sorting the (-squared distance) entries from largest to smallest puts the closest point first
+        heap.sort(reverse = True)
+        neighbors = [point for _, point in heap]
+        if ids:
+            neighbors = np.array(neighbors, dtype = np.int64)
+        distances = [math.sqrt(-neg_distance) for neg_distance, _ in heap]
+        return neighbors, distances
+
+    def inorder(self):
+    # A copy, so the caller can't change the cached list
+        return list(self.layout())
     
-    def draw(self, fig):
+    def draw(self, fig, levels = None, max_depth = None, max_points = None, bounds = None):
         """
-        Draws the 2D and 3D Scatter Plots in Plotly along with the "barriers" (2D Plane)
+        Draws the 2D and 3D Scatter Plots in Plotly along with the "barriers" (2D Plane),
+        for a big tree max_depth and max_points keep the figure the same size however many points it holds
+
+        Args:
+            levels (int): only draw the barriers of the nodes in the top this many levels of the tree, None for all of them
+            (or for the levels drawn in the 2D Representation when there is a max_depth)
+            max_depth (int): only draw the top this many levels of the 2D Representation, the subtrees below them
+            are drawn as one marker each with their size, None for every level
+            max_points (int): most points to draw in the 3D Scatter Plot (see KDNode.sample), None for all of them
+            bounds (tuple): the (low, high) corners of the box to draw in the 3D Scatter Plot, the barriers are cut to it
+            and all of max_points go to the points inside it, so zooming in shows more detail. None for everything
 
         Returns:
             plotly figure: the figure that contains both the 2D and 3D Scatter Plots with the barriers
         """
-        list = self.inorder()
+        list = self.layout()
         if self.root:
-            self.root.draw(0, fig)
-            self.barriers, fig = self.root.plot(list, fig)
-        self.list = list
+            self.root.draw(0, fig, max_depth)
+        # The barriers reach as far as the data does (with the EPSILON of room on every side)
+            low = tuple(value - EPSILON for value in self.root.low)
+            high = tuple(value + EPSILON for value in self.root.high)
+            if bounds is not None:
+                low = tuple(max(value, bound) for value, bound in zip(low, bounds[0]))
+                high = tuple(min(value, bound) for value, bound in zip(high, bounds[1]))
+            if levels is None:
+                levels = max_depth
+            weights = None
+            if bounds is not None or (max_points is not None and len(list) > max_points):
+                list, weights = self.root.sample(max_points, bounds)
+            self.barriers, fig = self.root.plot(list, fig, levels, low, high, weights)
         return fig
 
 # This method's main job is to export a json file of the tree for use on clientside callback:
     def to_dict(self):
         ret = None
         if self.root:
-            self.inorder()
-            self.root.find_depths(0)
+            self.layout()
             ret = self.root.to_dict()
         
         return ret
+
+    def to_flat_dict(self):
+        """
+        Exports the tree as columns instead of nested dictionaries: the nodes are numbered in preorder and
+        the coordinates, child rows (-1 for no child), axes (0, 1, 2 for X, Y, Z), inorder positions, depths
+        and tombstones are each one little endian typed array written as base64 (coordinates and depths in the
+        narrowest dtype that holds them exactly, so integer coordinates take 4 bytes), which the clientside
+        FlatKDTree reads straight into Float64Array/Int32Array/Uint8Array without building an object per node
+
+        Returns:
+            dict: {"format": "flat", "size", "root", "arrays": {name: {"dtype", "data"}}}
+        """
+        nodes = []
+        stack = [self.root] if self.root else []
+        if stack:
+            self.layout()
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.right:
+                stack.append(node.right)
+            if node.left:
+                stack.append(node.left)
+        rows = {id(node): row for row, node in enumerate(nodes)}
+
+        arrays = {
+            "coords": narrowest(np.array([(node.x, node.y, node.z) for node in nodes], dtype = float).reshape(-1, 3),
+                                ('<i4', '<f4', '<f8')),
+            "left": np.array([rows[id(node.left)] if node.left else -1 for node in nodes], dtype = '<i4'),
+            "right": np.array([rows[id(node.right)] if node.right else -1 for node in nodes], dtype = '<i4'),
+            "axis": np.array([LEVEL_DICT[node.level] for node in nodes], dtype = np.uint8),
+            "inorder_pos": np.array([node.inorder_pos for node in nodes], dtype = '<i4'),
+            "depth": narrowest(np.array([node.depth for node in nodes], dtype = np.int64), ('<i2', '<i4'))
+        }
+        deleted = np.array([node.deleted for node in nodes], dtype = np.uint8)
+        if deleted.any():
+            arrays["deleted"] = deleted
+        return {
+            "format": "flat",
+            "size": len(nodes),
+            "root": 0 if nodes else -1,
+            "arrays": {
+                name: {"dtype": array.dtype.name, "data": base64.b64encode(array.tobytes()).decode('ascii')}
+                for name, array in arrays.items()
+            }
+        }
+
 class KDNode:
-    def __init__(self, x, y, z, level, parent = None):
+    def __init__(self, x, y, z, level, parent = None, point_id = None):
         self.x = x
         self.y = y
         self.z = z
+    # The id of the point, its row in the tree's columns
+        self.id = point_id
         self.inorder_pos = 0
         self.depth = 0
         self.level = level
         self.parent = parent
         self.left = None
         self.right = None
+    # How many points are in the subtree and their bounding box, kept up to date as points are added
+        self.size = 1
+        self.low = [x, y, z]
+        self.high = [x, y, z]
+    # A removed point stays in the tree as a tombstone until its subtree is rebuilt, dead counts them in the subtree
+        self.deleted = False
+        self.dead = 0
+    # Adding the exact same point again only bumps its count, total counts every copy in the subtree
+        self.count = 1
+        self.total = 1
 
     def to_dict(self):
-        ret = {
-            "x": self.x,
-            "y": self.y,
-            "z": self.z,
-            "inorder_pos": self.inorder_pos,
-            "depth": self.depth,
-            "level": self.level,
-            "left": self.left.to_dict() if self.left else None,
-            "right": self.right.to_dict() if self.right else None
-        }
+        ret = None
+        stack = [(self, None, None)]
+    # Walk the subtree with a stack, every dictionary gets linked into its parent's dictionary as it is created
+        while stack:
+            node, parent_dict, side = stack.pop()
+            node_dict = {
+                "x": node.x,
+                "y": node.y,
+                "z": node.z,
+                "inorder_pos": node.inorder_pos,
+                "depth": node.depth,
+                "level": node.level,
+                "left": None,
+                "right": None
+            }
+            if node.deleted:
+                node_dict["deleted"] = True
+            if node.count > 1:
+                node_dict["count"] = node.count
+            if parent_dict is None:
+                ret = node_dict
+            else:
+                parent_dict[side] = node_dict
+            if node.right:
+                stack.append((node.right, node_dict, "right"))
+            if node.left:
+                stack.append((node.left, node_dict, "left"))
         return ret
     
-    def add(self, x, y, z):
+    def add(self, x, y, z, alpha = None, point_id = None):
         """
-        Recursively traverses through KDNodes, until there's a spot to add the node
+        Traverses through KDNodes, until there's a spot to add the node
         similar to other tree algorithms, except worrying about levels for the compare argument
-        with each specific coordinate
+        with each specific coordinate, it walks down with a loop so deep trees never hit the recursion limit.
+        A point tied with a node on its level goes right, and a point that is already in the tree only gets its count bumped
 
         Args:
             x (float): an x-coordinate of the node to be added
             y (float): an y-coordinate of the node to be added
             z (float): an z-coordinate of the node to be added
+            alpha (float): largest share of a subtree's nodes one of its children may hold, None skips the check
+            point_id (int): the id for the point if it gets a new node
+
+        Returns:
+            node (KDNode): the node holding the point
+            scapegoat (KDNode): when the new node ended up deeper than log(n) / log(1 / alpha), the lowest node on its path
+            that is out of balance (rebuilding it brings the depth back down), None otherwise
         """
-    
-        if self.level == X_LEVEL:
-            if x < self.x:
-                if self.left:
-                    self.left.add(x,y,z)
-                else:
-                    self.left = KDNode(x,y,z, Y_LEVEL, self)
-            elif x > self.x:
-                if self.right:
-                    self.right.add(x,y,z)
-                else:
-                    self.right = KDNode(x,y,z, Y_LEVEL, self)
-        elif self.level == Y_LEVEL:
-            if y < self.y:
-                if self.left:
-                    self.left.add(x,y,z)
-                else:
-                    self.left = KDNode(x,y,z, Z_LEVEL, self)
-            elif y > self.y:
-                if self.right:
-                    self.right.add(x,y,z)
-                else:
-                    self.right = KDNode(x,y,z, Z_LEVEL, self)
-        elif self.level == Z_LEVEL:
-            if z < self.z:
-                if self.left:
-                    self.left.add(x,y,z)
-                else:
-                    self.left = KDNode(x,y,z, X_LEVEL, self)                    
-            elif z > self.z:
-                if self.right:
-                    self.right.add(x,y,z)
-                else:
-                    self.right = KDNode(x,y,z, X_LEVEL, self)
+    # Like a scapegoat tree, the balance is only checked when the new node is too deep, so small lopsided
+    # subtrees that don't hurt the depth aren't rebuilt over and over
+        too_deep = math.log(self.size + self.dead + 1) / math.log(1 / alpha) if alpha else None
+        depth = 0
+        node = self
+        while True:
+            if node.x == x and node.y == y and node.z == z:
+            # Another copy of a point in the tree (adding a removed point again brings its tombstone back)
+                revived = node.deleted
+                node.deleted = False
+                node.count += 1
+                found = node
+                while node:
+                    node.total += 1
+                    if revived:
+                        node.size += 1
+                        node.dead -= 1
+                    node = node.parent
+                return found, None
+            if node.level == X_LEVEL:
+                value, split, next_level = x, node.x, Y_LEVEL
+            elif node.level == Y_LEVEL:
+                value, split, next_level = y, node.y, Z_LEVEL
+            else:
+                value, split, next_level = z, node.z, X_LEVEL
+            if value < split:
+                if not node.left:
+                    node.left = child = KDNode(x,y,z, next_level, node, point_id)
+                    break
+                node = node.left
+            else:
+                if not node.right:
+                    node.right = child = KDNode(x,y,z, next_level, node, point_id)
+                    break
+                node = node.right
+            depth += 1
+    # Every subtree on the way back up to the root got one more point
+        new_node = child
+        scapegoat = None
+        unbalanced = alpha and depth + 1 > too_deep
+        while node:
+            node.size += 1
+            node.total += 1
+            low, high = node.low, node.high
+            low[0], low[1], low[2] = min(low[0], x), min(low[1], y), min(low[2], z)
+            high[0], high[1], high[2] = max(high[0], x), max(high[1], y), max(high[2], z)
+        # Tombstones still take up a level, so the balance counts every node
+            if unbalanced and child.size + child.dead > alpha * (node.size + node.dead):
+                scapegoat = node
+                unbalanced = False
+            child = node
+            node = node.parent
+        return new_node, scapegoat
 
-    def find(self, x, y, z, path):
+    def remove(self, x, y, z):
+        """
+        Takes one copy of (x, y, z) off its node, the node becomes a tombstone once no copies are left,
+        the caller takes care of the sizes
+
+        Args:
+            x (float): an x-coordinate of the node to be removed
+            y (float): an y-coordinate of the node to be removed
+            z (float): an z-coordinate of the node to be removed
+
+        Returns:
+            KDNode: the node that lost a copy (its deleted flag tells if it was the last one), None if the point is not in the subtree
         """
-        Finds if the target node is in the Tree, records the path to the target node,
+        node = self
+        while node:
+            if not node.deleted and node.x == x and node.y == y and node.z == z:
+                node.count -= 1
+                node.deleted = not node.count
+                return node
+        # Points tied with a node on its level are on its right
+            if node.level == X_LEVEL:
+                value, split = x, node.x
+            elif node.level == Y_LEVEL:
+                value, split = y, node.y
+            else:
+                value, split = z, node.z
+            node = node.left if value < split else node.right
+        return None
+
+    def find(self, x, y, z, path = None):
+        """
+        Finds if the target node is in the Tree, and if a path is given records the path to the target node,
         along with the distance between the target node and the nodes traversed to the target node using the distance formula
 
         Args:
             x (float): an x-coordinate of the node to be found
             y (float): an y-coordinate of the node to be found
             z (float): an z-coordinate of the node to be found
-            path (dict): records the root -> intermediary nodes -> target node
+            path (dict): records the root -> intermediary nodes -> target node, nothing is recorded when it is None
 
         Returns:
             bool: True if the node is found in the tree, False otherwise
         """
     # Assume innocent until proven guilty...
         ret = False
-    # Add the current node to the path so far...
-        tree_coordinates = (self.x,self.y, self.z)
-        representation_coordinates = (self.inorder_pos, self.depth)
-    # Using the Distance Formula on the current node and the target node
-        distance = math.sqrt((self.x - x)**2 + (self.y - y)**2 + (self.z - z)**2)
-        path[representation_coordinates] = (tree_coordinates, distance)
-    # Checks if we have found the node if all coordinates match
-        if self.x == x and self.y == y and self.z == z:
-            ret = True
-    # Continue traversing until we get closer to the target node:
-    # Again, similar to the add function here:
-        if self.level == X_LEVEL:
-            if x < self.x and self.left:
-                ret = self.left.find(x,y,z, path)
-            elif x > self.x and self.right:
-                ret = self.right.find(x,y,z, path)
-        elif self.level == Y_LEVEL:
-            if y < self.y and self.left:
-                ret = self.left.find(x,y,z, path)
-            elif y > self.y and self.right:
-                ret = self.right.find(x,y,z, path)  
-        elif self.level == Z_LEVEL:
-            if z < self.z and self.left:
-                ret = self.left.find(x,y,z, path)          
-            elif z > self.z and self.right:
-                ret = self.right.find(x,y,z, path)
+        node = self
+        while node:
+        # Add the current node to the path so far (only when someone asked for it)...
+            if path is not None:
+            # Using the Distance Formula on the current node and the target node
+                dx, dy, dz = node.x - x, node.y - y, node.z - z
+                path[(node.inorder_pos, node.depth)] = ((node.x, node.y, node.z), math.sqrt(dx*dx + dy*dy + dz*dz))
+        # Checks if we have found the node if all coordinates match, a point only ever has one node
+            if node.x == x and node.y == y and node.z == z:
+                ret = not node.deleted
+                break
+        # Continue traversing until we get closer to the target node:
+        # Again, similar to the add function here (ties go right):
+            if node.level == X_LEVEL:
+                value, split = x, node.x
+            elif node.level == Y_LEVEL:
+                value, split = y, node.y
+            else:
+                value, split = z, node.z
+            if value < split:
+                node = node.left
+            else:
+                node = node.right
         return ret
 
-    def find_sphere_neighbors(self, a,b,c,r, neighbors, traversal_coordinates, inorder_neighbors):
+    def find_sphere_neighbors(self, a, b, c, r, neighbors, visit = None, ids = False):
         """
-        Finds the Sphere's neighbors that are within the sphere by checking if its inside the sphere
+        Finds the Sphere's neighbors that are within the sphere by checking if its inside the sphere,
+        visit is the hook for tracing the traversal, it is called with every visited node in order
 
         Args:
             a (float): x-coordinate of the center of the sphere
@@ -258,202 +1217,486 @@ class KDNode:
             c (float): z-coordinate of the center of the sphere
             r (float): radius of the sphere
             neighbors (list):  all the neighbors in the sphere
-            traversal_coordinates (list): contains a sublist of the 2D Coordinate and 3D Coordinates of traversed neighbors
-            inorder_neighbors (list): if there are no neighbors in the current traversal, it will be None, 
-            otherwise it has the 2D coordinate
-        """
-    # Calculates the distance of the current node with the center of the sphere
-        distance = math.sqrt((self.x - a)**2 + (self.y - b)**2 + (self.z - c)**2)
-    # Checks to see if the center of the sphere is the current node
-        current_point = (self.x, self.y, self.z)
-        current_point_2D_val = (self.inorder_pos, self.depth)
-        center_point = (a,b,c)
-        isCenter = current_point == center_point
-
-        traversal_coordinates.append([current_point_2D_val,current_point])
-
-    #If it's a neighbor because the distance is in range of the sphere
-        if distance <= r:
-            inorder_neighbors.append(current_point_2D_val)
-            if not isCenter:
-                neighbors.append(current_point)
-        else:
-            inorder_neighbors.append(None)
+            visit (callable): called as visit(node, inside) for every visited node, where inside is True
+            if the node is in the sphere, None skips the tracing
+            ids (bool): collect the ids of the neighbors instead of their coordinates
+        """
+        r2 = r*r if r >= 0 else -1.0
+    # The stack replaces the recursion, the far side is pushed first so the near side is still explored first
+        stack = [self]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+        # Calculates the squared distance of the current node with the center of the sphere
+            dx, dy, dz = node.x - a, node.y - b, node.z - c
+            distance = dx*dx + dy*dy + dz*dz
+            inside = distance <= r2 and not node.deleted
+        # The center of the sphere is not its own neighbor
+            if inside and distance:
+                neighbors.append(node.id if ids else (node.x, node.y, node.z))
+            if visit is not None:
+                visit(node, inside)
 
-    # Traverse based on the current level of the tree:
-        current_node_axis_value = current_point[LEVEL_DICT[self.level]]
-        center_axis_value = center_point[LEVEL_DICT[self.level]]
-        
-    #Based on the Tree Algorithm go the next applicable node:
-        if center_axis_value < current_node_axis_value:
-            if self.left:
-                self.left.find_sphere_neighbors(a,b,c,r,neighbors, traversal_coordinates, inorder_neighbors)
-            # Check the right subtree if it might contain closer neighbors:
-            if abs(center_axis_value - current_node_axis_value) <= r and self.right:
-                self.right.find_sphere_neighbors(a,b,c,r,neighbors, traversal_coordinates, inorder_neighbors)
-        else:
-            if self.right:
-                self.right.find_sphere_neighbors(a,b,c,r,neighbors, traversal_coordinates, inorder_neighbors)
-            # Check the left subtree if it might contain closer neighbors:
-            if abs(center_axis_value - current_node_axis_value) <= r and self.left:
-                self.left.find_sphere_neighbors(a,b,c,r,neighbors, traversal_coordinates, inorder_neighbors)
-        
-    def create_barrier(self, barrier_list, isLeft):
+        #Based on the Tree Algorithm go the next applicable node:
+            near, far, gap = node.split(a, b, c)
+        # Check the other subtree if it might contain closer neighbors:
+            if far and gap <= r:
+                push(far)
+            if near:
+                push(near)
+
+    def sphere_neighbors(self, a, b, c, r, neighbors, ids = False):
         """
-        Creates the "barriers" for each node, which outlines the division between values smaller and larger than its respective level
+        The lean version of find_sphere_neighbors: compares squared distances against r² and records nothing
+        for the animation. Every stack entry carries the squared distance from the center to the cell of its
+        subtree (built up one splitting plane at a time), so a subtree is skipped once the whole cell is out of reach,
+        not only when the last splitting plane is
 
         Args:
-            barrier_list (list): records the surfaces so far for each node in the tree
-            isLeft (bool): True if on the left side of the graph, False on the right side
+            a (float): x-coordinate of the center of the sphere
+            b (float): y-coordinate of the center of the sphere
+            c (float): z-coordinate of the center of the sphere
+            r (float): radius of the sphere
+            neighbors (list): all the (x,y,z) neighbors in the sphere, except for the center itself
+            ids (bool): collect the ids of the neighbors instead of their coordinates
         """
-    #TODO: Change to the self.min_overall_value and self.max_overall_value to avoid magic numbers:
-        min_x_val = min_y_val = min_z_val = 0
-        max_x_val = max_y_val = max_z_val = 100
-    # Checks if the Node has a parent at a certain level
-        if self.parent:
-            if self.parent.level == X_LEVEL:
-            # Since the Node is at the Y-Level, you have to bound it to the X-Value of the parent
-                if isLeft:
-                    max_x_val = self.parent.x
-                else:
-                    min_x_val = self.parent.x
-
-            elif self.parent.level == Y_LEVEL:
-            # Bound the X Value to the last parent with an X-Level
-                root = self.parent
-                while root.parent and root.parent.level == X_LEVEL:
-                    root = root.parent
-            #Maintain the bound by the node's x-value
-                if root.x < self.x:
-                    min_x_val = root.x
-                else:
-                    max_x_val = root.x
+    # A negative radius holds nothing, like in find_sphere_neighbors
+        r2 = r*r if r >= 0 else -1.0
+    # Entries are (node, squared distance to the cell, offset of the cell along x, y and z)
+        stack = [(self, 0.0, 0.0, 0.0, 0.0)]
+        pop = stack.pop
+        push = stack.append
+        append = neighbors.append
+        while stack:
+            node, cell, ox, oy, oz = pop()
+            x, y, z = node.x, node.y, node.z
+            dx, dy, dz = x - a, y - b, z - c
+            distance = dx*dx + dy*dy + dz*dz
+            if distance <= r2 and distance and not node.deleted:
+                append(node.id if ids else (x, y, z))
 
-            # Since the Node is at the Z-Level, you have to bound it to the Y-Value of the parent
-                if isLeft:
-                    max_y_val = self.parent.y
+        # Same rule as split: the center goes right on ties, crossing the plane replaces the offset on its axis
+            level = node.level
+            if level == X_LEVEL:
+                if dx > 0:
+                    near, far = node.left, node.right
                 else:
-                    min_y_val = self.parent.y
+                    near, far = node.right, node.left
+                if far:
+                    far_cell = cell - ox*ox + dx*dx
+                    if far_cell <= r2:
+                        push((far, far_cell, dx, oy, oz))
+            elif level == Y_LEVEL:
+                if dy > 0:
+                    near, far = node.left, node.right
+                else:
+                    near, far = node.right, node.left
+                if far:
+                    far_cell = cell - oy*oy + dy*dy
+                    if far_cell <= r2:
+                        push((far, far_cell, ox, dy, oz))
             else:
-            # Bound the Y Value to the last parent with an Y-Level
-                root = self.parent
-                while root.parent and root.parent.level == Y_LEVEL:
-                    root = root.parent
-            #Maintain the bound by the node's y-value
-                if root.y < self.y:
-                    min_y_val = root.y
+                if dz > 0:
+                    near, far = node.left, node.right
                 else:
-                    max_y_val = root.y
+                    near, far = node.right, node.left
+                if far:
+                    far_cell = cell - oz*oz + dz*dz
+                    if far_cell <= r2:
+                        push((far, far_cell, ox, oy, dz))
+            if near:
+                push((near, cell, ox, oy, oz))
 
-            # Since the Node is at the X-Level, you have to bound it to the Z-Value of the parent
-                if isLeft:
-                    max_z_val = self.parent.z
+    def range_query(self, x0, x1, y0, y1, z0, z1, found, ids = False):
+        """
+        Finds every point in the subtree inside the box [x0, x1] x [y0, y1] x [z0, z1], subtrees whose bounding box
+        misses the box are skipped and subtrees whose bounding box is inside the box are taken whole
+
+        Args:
+            x0, x1 (float): smallest and largest x of the box
+            y0, y1 (float): smallest and largest y of the box
+            z0, z1 (float): smallest and largest z of the box
+            found (list): all the (x,y,z) points inside the box
+            ids (bool): collect the ids of the points instead of their coordinates
+        """
+        stack = [self]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+            low, high = node.low, node.high
+            if high[0] < x0 or low[0] > x1 or high[1] < y0 or low[1] > y1 or high[2] < z0 or low[2] > z1:
+                continue
+            if x0 <= low[0] and high[0] <= x1 and y0 <= low[1] and high[1] <= y1 and z0 <= low[2] and high[2] <= z1:
+                if ids:
+                    node.points(None, ids = found)
                 else:
-                    min_z_val = self.parent.z
+                    node.points(found)
+                continue
+            x, y, z = node.x, node.y, node.z
+            if x0 <= x <= x1 and y0 <= y <= y1 and z0 <= z <= z1 and not node.deleted:
+                found.append(node.id if ids else (x, y, z))
+            if node.left:
+                push(node.left)
+            if node.right:
+                push(node.right)
+
+    def count_box(self, x0, x1, y0, y1, z0, z1):
+        """
+        Counts the points of the subtree inside the box [x0, x1] x [y0, y1] x [z0, z1] without collecting them,
+        every copy of a repeated point counts, and a subtree whose bounding box is inside the box adds its stored total
+
+        Args:
+            x0, x1 (float): smallest and largest x of the box
+            y0, y1 (float): smallest and largest y of the box
+            z0, z1 (float): smallest and largest z of the box
 
-    # Start Creating the arrays to use for the plotly Surface object
+        Returns:
+            int: how many points are inside the box
+        """
+        count = 0
+        stack = [self]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+            low, high = node.low, node.high
+            if high[0] < x0 or low[0] > x1 or high[1] < y0 or low[1] > y1 or high[2] < z0 or low[2] > z1:
+                continue
+            if x0 <= low[0] and high[0] <= x1 and y0 <= low[1] and high[1] <= y1 and z0 <= low[2] and high[2] <= z1:
+                count += node.total
+                continue
+            x, y, z = node.x, node.y, node.z
+        # A tombstone's count is 0
+            if x0 <= x <= x1 and y0 <= y <= y1 and z0 <= z <= z1:
+                count += node.count
+            if node.left:
+                push(node.left)
+            if node.right:
+                push(node.right)
+        return count
+
+    def count_sphere(self, a, b, c, r):
+        """
+        Counts the points of the subtree within r of (a, b, c) without collecting them, every copy of a repeated point counts,
+        a subtree whose bounding box is entirely out of reach is skipped and one whose farthest corner is within r adds its stored total
+
+        Args:
+            a (float): x-coordinate of the center of the sphere
+            b (float): y-coordinate of the center of the sphere
+            c (float): z-coordinate of the center of the sphere
+            r (float): radius of the sphere
+
+        Returns:
+            int: how many points are in the sphere, a point sitting on the center included
+        """
+        r2 = r*r
+        count = 0
+        stack = [self]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+            low, high = node.low, node.high
+        # Where the bounding box starts and ends relative to the center, along each axis
+            lx, hx = low[0] - a, high[0] - a
+            ly, hy = low[1] - b, high[1] - b
+            lz, hz = low[2] - c, high[2] - c
+        # The closest the box gets to the center...
+            dx = lx if lx > 0 else (hx if hx < 0 else 0.0)
+            dy = ly if ly > 0 else (hy if hy < 0 else 0.0)
+            dz = lz if lz > 0 else (hz if hz < 0 else 0.0)
+            if dx*dx + dy*dy + dz*dz > r2:
+                continue
+        # ...and its farthest corner
+            dx = hx if hx > -lx else lx
+            dy = hy if hy > -ly else ly
+            dz = hz if hz > -lz else lz
+            if dx*dx + dy*dy + dz*dz <= r2:
+                count += node.total
+                continue
+            dx, dy, dz = node.x - a, node.y - b, node.z - c
+            if dx*dx + dy*dy + dz*dz <= r2:
+                count += node.count
+            if node.left:
+                push(node.left)
+            if node.right:
+                push(node.right)
+        return count
+
+    def points(self, found, counts = None, ids = None):
+        """
+        Collects every point of the subtree once, leaving out the tombstones
+
+        Args:
+            found (list): the (x,y,z) points of the subtree get appended to it, None skips them
+            counts (list): if given, how many copies of each of those points there are gets appended to it
+            ids (list): if given, the id of each of those points gets appended to it
+        """
+        stack = [self]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+            if not node.deleted:
+                if found is not None:
+                    found.append((node.x, node.y, node.z))
+                if counts is not None:
+                    counts.append(node.count)
+                if ids is not None:
+                    ids.append(node.id)
+            if node.left:
+                push(node.left)
+            if node.right:
+                push(node.right)
+
+    def split(self, a, b, c):
+        """
+        Compares a point with this node on the node's level, to pick which child to explore first
+
+        Args:
+            a (float): x-coordinate of the point
+            b (float): y-coordinate of the point
+            c (float): z-coordinate of the point
+
+        Returns:
+            near (KDNode): the child on the point's side of the splitting plane (ties go right)
+            far (KDNode): the other child
+            gap (float): distance from the point to the splitting plane, nothing in far can be closer than this
+        """
         if self.level == X_LEVEL:
-        # Create a surface perpendicular to X axis
-            x = self.x * np.ones((2, 2))
-            y = np.array([[min_y_val, max_y_val], [min_y_val, max_y_val]])
-            z = np.array([[min_z_val, min_z_val], [max_z_val, max_z_val]])
-            colorpalette = "Reds"
+            current_node_axis_value, center_axis_value = self.x, a
         elif self.level == Y_LEVEL:
-        # Create a surface perpendicular to Y axis
-            x = np.array([[min_x_val, min_x_val], [max_x_val, max_x_val]])
-            y = self.y * np.ones((2, 2))
-            z = np.array([[min_z_val, max_z_val], [min_z_val, max_z_val]])
-            colorpalette = "Greens"
+            current_node_axis_value, center_axis_value = self.y, b
         else:
-        # Create a surface perpendicular to Z axis
-            x = np.array([[min_x_val, max_x_val], [min_x_val, max_x_val]])
-            y = np.array([[min_y_val, min_y_val], [max_y_val, max_y_val]])
-            z = self.z * np.ones((2, 2))
-            colorpalette = "Teal"
-
-    #Create the plotly graph object surface based on the arrays above,
-        surf = go.Surface(
-            x=x, 
-            y=y, 
-            z=z, 
-            showscale=False, 
-            colorscale=colorpalette,
-            opacity=0.5, 
-            visible=True,
-            name = f"{(self.x,self.y,self.z)}"
-        )
-    # Add the surface to the barrier list to use later for the figure
-        barrier_list.append(surf)
-
-    #Continue iterating through the rest of the tree
-        if self.left:
-            self.left.create_barrier(barrier_list, isLeft = True)
-        if self.right:
-            self.right.create_barrier(barrier_list, isLeft = False)
+            current_node_axis_value, center_axis_value = self.z, c
+        if center_axis_value < current_node_axis_value:
+            return self.left, self.right, current_node_axis_value - center_axis_value
+        return self.right, self.left, center_axis_value - current_node_axis_value
+
+    def knn(self, x, y, z, k, heap, ids = False):
+        """
+        Finds the k closest points to (x, y, z) in the subtree, keeping a max-heap of the best k seen so far,
+        a far subtree is skipped once its splitting plane is further away than the current k-th closest point
+
+        Args:
+            x (float): x-coordinate of the query point
+            y (float): y-coordinate of the query point
+            z (float): z-coordinate of the query point
+            k (int): how many points to find
+            heap (list): heapq entries of (-squared distance, (x,y,z)), holds at most k entries when done
+            ids (bool): the entries hold the ids of the points instead of their coordinates
+        """
+    # Each stack entry carries the smallest squared distance anything in that subtree could have
+        stack = [(self, 0.0)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node, bound = pop()
+            if len(heap) == k and bound >= -heap[0][0]:
+                continue
+            if not node.deleted:
+                dx, dy, dz = node.x - x, node.y - y, node.z - z
+                entry = (-(dx*dx + dy*dy + dz*dz), node.id if ids else (node.x, node.y, node.z))
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+            near, far, gap = node.split(x, y, z)
+            if far:
+                push((far, max(bound, gap*gap)))
+            if near:
+                push((near, bound))
+
+    def cells(self, low, high, levels = None):
+        """
+        Works out the cell of every node in the subtree (the box of space the node splits in two) in one pass from the top down,
+        a child's cell is its parent's cell cut at the parent's splitting value, so no node has to look back at its ancestors
+
+        Args:
+            low (tuple): the smallest (x, y, z) of this node's cell
+            high (tuple): the largest (x, y, z) of this node's cell
+            levels (int): only go through the top this many levels of the subtree, None for all of them
+
+        Returns:
+            nodes (list): the nodes in preorder
+            indexes (list): how many levels below this node each node is
+            cells (np.ndarray): (N, 2, 3) array with the low and high corner of every node's cell
+        """
+        nodes = []
+        indexes = []
+        bounds = []
+        stack = [(self, 0, tuple(low), tuple(high))]
+        while stack:
+            node, index, low, high = stack.pop()
+            nodes.append(node)
+            indexes.append(index)
+            bounds.append((low, high))
+            if levels is not None and index + 1 >= levels:
+                continue
+            axis = LEVEL_DICT[node.level]
+            value = (node.x, node.y, node.z)[axis]
+            if node.right:
+                stack.append((node.right, index + 1, low[:axis] + (value,) + low[axis + 1:], high))
+            if node.left:
+                stack.append((node.left, index + 1, low, high[:axis] + (value,) + high[axis + 1:]))
+        return nodes, indexes, np.array(bounds, dtype = float).reshape(-1, 2, 3)
 
     def inorder(self, num, key_list):
-    # Taken from the inorder method of the other tree assignments, with a slight change
-        if self.left:
-            self.left.inorder(num, key_list)
-        self.inorder_pos = num[0]
-    #The key_list has a tuple of the (x,y,z) coordinates
-        key_list.append((self.x,self.y,self.z))
-        num[0] += 1
-        if self.right:
-            self.right.inorder(num, key_list)
-    
+    # Taken from the inorder method of the other tree assignments, with a slight change (a stack instead of recursion)
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        append = key_list.append
+        pos = num[0]
+        node = self
+        while True:
+            while node is not None:
+                push(node)
+                node = node.left
+            if not stack:
+                break
+            node = pop()
+            node.inorder_pos = pos
+        #The key_list has a tuple of the (x,y,z) coordinates, tombstones keep their spot in the drawing but aren't listed
+            if not node.deleted:
+                append((node.x,node.y,node.z))
+            pos += 1
+            node = node.right
+        num[0] = pos
+
     def find_depths(self,y):
-        self.depth = y
-        y_next = y - 1
-        if self.left:
-            self.left.find_depths(y_next)
-        if self.right:
-            self.right.find_depths(y_next)
-
-    def draw(self, y, fig):
-    # Similar to the draw method made in the 2D Tree assignment except using plotly instead of matplotlib
-        x = self.inorder_pos
-        self.depth = y
-
-    # Basically Creates a point in the scatter plot with hover text that gives info about the node's coordinates and level
-        fig.add_trace(go.Scatter(x = [x], y = [y], 
-                                 mode = 'markers', 
-                                 hovertext= f"{(self.x, self.y, self.z, self.level)}",
+    # Goes one level at a time, every node on a level has the same depth
+        level = [self]
+        while level:
+            for node in level:
+                node.depth = y
+            level = [child for node in level for child in (node.left, node.right) if child]
+            y -= 1
+
+    def draw(self, y, fig, max_depth = None):
+        """
+        Draws the 2D Representation of the subtree as two traces, one line trace with every edge (separated by None)
+        and one markers trace on top of it with every node in preorder, so the figure size grows linearly with the tree
+        and the traversal animation recolors the nodes through the marker's color array.
+        Below max_depth levels every subtree is a single marker of a third trace, labeled with how many points it holds
+        (total, so a repeated point counts every copy like the weights of sample)
+
+        Args:
+            y (int): the depth of this node in the drawing
+            fig (plotly figure): the figure to add the traces to
+            max_depth (int): how many levels of the subtree to draw, None for all of them
+        """
+        node_x, node_y, hovertext = [], [], []
+        edge_x, edge_y = [], []
+        subtree_x, subtree_y, subtree_sizes = [], [], []
+        bottom = None if max_depth is None else y - max_depth + 1
+        stack = [(self, y)]
+        while stack:
+            node, y = stack.pop()
+            node.depth = y
+            x = node.inorder_pos
+            node_x.append(x)
+            node_y.append(y)
+            hovertext.append(f"{(node.x, node.y, node.z, node.level)}")
+            for child in (node.right, node.left):
+                if child:
+                    edge_x += [x, child.inorder_pos, None]
+                    edge_y += [y, y - 1, None]
+                    if bottom is not None and y <= bottom:
+                        subtree_x.append(child.inorder_pos)
+                        subtree_y.append(y - 1)
+                        subtree_sizes.append(child.total)
+                    else:
+                        stack.append((child, y - 1))
+    # NumPy arrays skip plotly's check of every list element, the gaps are NaN which plotly exports as null
+        edge_x = np.array(edge_x, dtype = float)
+        edge_y = np.array(edge_y, dtype = float)
+    # Similar to the matplotlib but we "skip" the hoverinfo not to override the hoverinfo on the points
+        fig.add_trace(go.Scatter(x = edge_x, y = edge_y,
+                                 mode = 'lines',
+                                 name = 'edges',
+                                 hoverinfo = 'skip',
+                                 line = dict(color = 'black', width = 3)))
+    # Basically every point in the scatter plot has hover text that gives info about the node's coordinates and level
+        fig.add_trace(go.Scatter(x = np.array(node_x), y = np.array(node_y),
+                                 mode = 'markers',
+                                 name = 'nodes',
+                                 hovertext = np.array(hovertext),
                                  hoverinfo = 'text',
                                  marker = dict(color = 'black',
                                                size = 15)))
-        y_next = y-1
-        if self.left:
-            x_next = self.left.inorder_pos
-    # Similar to the matplotlib but we "skip" the hoverinfo not to override the hoverinfo on the points
-            fig.add_trace(go.Scatter(x = [x, x_next], y = [y, y_next], hoverinfo = 'skip', line = dict(color = 'black', width = 3)))
-            fig.add_trace(go.Scatter(x = [x], y = [y], 
-                            mode = 'markers', 
-                            hovertext= f"{(self.x, self.y, self.z, self.level)}",
-                            hoverinfo = 'text',
-                            marker = dict(color = 'black',
-                                          size = 15)))
-            self.left.draw(y_next, fig)
-        if self.right:
-            x_next = self.right.inorder_pos
-            fig.add_trace(go.Scatter(x = [x, x_next], y = [y, y_next], hoverinfo = 'skip', line = dict(color = 'black', width = 3)))
-            fig.add_trace(go.Scatter(x = [x], y = [y], 
-                mode = 'markers', 
-                hovertext= f"{(self.x, self.y, self.z, self.level)}",
-                hoverinfo = 'text',
-                marker = dict(color = 'black',
-                              size = 15)))
-            self.right.draw(y_next, fig)
-
-    def plot(self, list, fig):
+        if subtree_sizes:
+        # The subtrees that are not drawn, after the nodes so the animation still finds the nodes' trace first
+            fig.add_trace(go.Scatter(x = np.array(subtree_x), y = np.array(subtree_y),
+                                     mode = 'markers+text',
+                                     name = 'subtrees',
+                                     text = np.array(subtree_sizes).astype(str),
+                                     textposition = 'bottom center',
+                                     customdata = np.array(subtree_sizes),
+                                     hovertemplate = "%{customdata} points below<extra></extra>",
+                                     marker = dict(color = 'grey',
+                                                   size = 15,
+                                                   symbol = 'triangle-down')))
+
+    def sample(self, limit = None, bounds = None):
+        """
+        Picks the points of the subtree to draw when there are too many, going down a whole level at a time so every
+        point drawn is a node and the lowest ones stand in for the subtrees below them. The tree splits at medians,
+        so the subtrees on a level hold about as many points each and dense regions get more of the points drawn
+
+        Args:
+            limit (int): most points to pick, None for all of them
+            bounds (tuple): the (low, high) corners of the box to pick points in, None for everywhere
+
+        Returns:
+            points (list): the (x,y,z) coordinates of the picked nodes, in breadth first order
+            weights (np.ndarray): how many points each picked node stands for (itself and the subtrees below it not picked)
+        """
+        def contains(low, high):
+            return bounds is None or all(bound_low <= value_high and value_low <= bound_high for bound_low, value_low, value_high, bound_high
+                                         in zip(bounds[0], low, high, bounds[1]))
+
+        points = []
+        weights = []
+        level = [(self, None)]
+        while level:
+        # A removed point is never drawn, the nodes below it count towards whatever stands in for it
+            drawn = [not node.deleted and contains((node.x, node.y, node.z), (node.x, node.y, node.z)) for node, parent in level]
+            if limit is not None and points and len(points) + sum(drawn) > limit:
+                break
+            next_level = []
+            for (node, parent), draw in zip(level, drawn):
+                if draw:
+                    parent = len(points)
+                    points.append((node.x, node.y, node.z))
+                    weights.append(node.count)
+                for child in (node.left, node.right):
+                    if child and contains(child.low, child.high):
+                        next_level.append((child, parent))
+            level = next_level
+    # Whatever is left stands for its whole subtree (total counts its live points)
+        for node, parent in level:
+            if parent is not None:
+                weights[parent] += node.total
+        return points, np.array(weights, dtype = np.int64)
+
+    def plot(self, list, fig, levels = None, low = (0, 0, 0), high = (100, 100, 100), weights = None):
         """
         Creates the 3D Plot Figure for the 3D KD Tree
 
         Args:
             list (list): the key_list used in the inorder that contains all the nodes' x, y, and z coordinates
+            levels (int): only draw the barriers of the top this many levels of the tree, None for all of them
+            low (tuple): the smallest (x, y, z) the barriers reach
+            high (tuple): the largest (x, y, z) the barriers reach
+            weights (np.ndarray): how many points each point of the list stands for (see sample),
+            the markers grow with it, None when every point is drawn
 
         Returns:
-            barriers (list): a list of plotly graph objects for the surfaces
+            barriers (list): the Mesh3d traces with the barriers, one per level (X, Y and Z)
             fig (plotly object): added data for the 3D Plot into the figure for plotly
         """
     # Arranges all the X, Y, Z values into lists to use for the scatter3d plot
@@ -462,18 +1705,23 @@ class KDNode:
         y_vals = [list[i][1] for i in range(length)]
         z_vals = [list[i][2] for i in range(length)]
 
-        barriers = []
-    # Create the Barriers, since we're starting at the root, we assume that isLeft is true,
-        self.create_barrier(barriers,True)
+    # Create the Barriers, starting with the root's cell, which is everything being drawn
+        barriers = barrier_meshes(*self.cells(low, high, levels))
     
+    # A point standing in for many gets a bigger marker, growing with the log so the single points stay visible
+        sizes = None
+        if weights is not None and len(weights) and weights.max() > 1:
+            sizes = 1 + np.log2(weights)
+
         scatter = px.scatter_3d(x=x_vals, y=y_vals, z=z_vals, 
+                                size = sizes,
                                 color_discrete_sequence = ['black'],
                                 size_max=20, 
                                 opacity=0.7)
     # Add the Scatter3D Plot as a trace to the figure
         fig.add_trace(scatter.data[0])
 
-    # Add each barrier as a trace:
+    # Add the barriers of each level as a trace:
         for barrier in barriers:
             fig.add_trace(barrier)
         return barriers, fig
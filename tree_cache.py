@@ -0,0 +1,207 @@
+import os
+import json
+import tempfile
+import plotly.io as pio
+
+from collections import OrderedDict
+from tree import KDTree
+
+# Number of trees (with their figures) a TreeCache keeps in memory before it evicts the least recently used one
+DEFAULT_CAPACITY = 8
+
+
+class TreeCache:
+    """
+    Keeps named trees and their prebuilt figures for the Dash app. Every tree is saved once as a snapshot
+    (KDTree.save) in a directory shared by every worker process, which opens it as a memory mapped FlatKDTree,
+    so the index is only built by the first worker and the page cache holds a single copy of it.
+    On top of that each process keeps the trees it used last in an LRU, bounded by a number of entries and
+    optionally by bytes, and reloads an entry whenever its snapshot on disk has been replaced
+    """
+    def __init__(self, directory, capacity = DEFAULT_CAPACITY, max_bytes = None):
+        """
+        Args:
+            directory (str): where the snapshots are kept, created if it does not exist
+            capacity (int): most trees to keep in memory at once
+            max_bytes (int): most bytes of trees and figures to keep in memory at once, None for no limit
+        """
+        if capacity < 1:
+            raise ValueError(f"capacity has to be at least 1, got {capacity}")
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+    # name -> the tree and figure with the mtimes of the files they came from and their bytes,
+    # ordered from the least to the most recently used
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries or os.path.exists(self.path(name))
+
+    @property
+    def nbytes(self):
+        """
+        Returns:
+            int: bytes held by the trees and figures in memory (a memory mapped tree counts the size of its arrays)
+        """
+        return sum(entry["nbytes"] for entry in self.entries.values())
+
+    def path(self, name, kind = "tree"):
+        """
+        Args:
+            name (str): the name of the tree
+            kind (str): "tree" for the snapshot of the tree, "figure" for the JSON of its figure
+
+        Returns:
+            str: the file the tree or figure is kept in
+        """
+        if not name or os.sep in name or name.startswith('.'):
+            raise ValueError(f"{name!r} can not be used as the name of a tree")
+        return os.path.join(self.directory, f"{name}.{'kdtree' if kind == 'tree' else 'figure.json'}")
+
+    def get(self, name, build = None, mmap = True):
+        """
+        Gives back the tree with this name, from memory if this process used it recently, otherwise from its
+        snapshot, and otherwise by building it and saving the snapshot for every other process
+
+        Args:
+            name (str): the name of the tree
+            build (callable): called without arguments to build the KDTree when there is no snapshot of it yet
+            mmap (bool): whether snapshots are opened as memory mapped FlatKDTrees (see KDTree.load)
+
+        Returns:
+            FlatKDTree or KDTree: the tree, None if it is nowhere and there is nothing to build it with
+        """
+        path = self.path(name)
+        mtime = self.mtime(path)
+        entry = self.entries.get(name)
+        if entry is not None and entry["tree"] is not None and entry["mtime"] == mtime:
+            self.hits += 1
+            self.entries.move_to_end(name)
+            return entry["tree"]
+
+        self.misses += 1
+        if mtime is None:
+            if build is None:
+                return None
+            self.write(path, build().save)
+            mtime = self.mtime(path)
+        tree = KDTree.load(path, mmap = mmap)
+        self.store(name, tree = tree, mtime = mtime)
+        return tree
+
+    def put(self, name, tree, figure = None):
+        """
+        Saves a (changed) tree as the snapshot for this name, replacing the one every process uses
+
+        Args:
+            name (str): the name of the tree
+            tree (KDTree): the tree to save
+            figure (plotly figure): its figure, if it should be replaced as well
+        """
+        path = self.path(name)
+        self.write(path, tree.save)
+        if figure is not None:
+            self.write(self.path(name, "figure"), lambda figure_path: pio.write_json(figure, figure_path))
+        self.store(name, tree = tree, mtime = self.mtime(path))
+
+    def figure(self, name, build = None):
+        """
+        Gives back the prebuilt figure of the tree with this name as a plotly figure dictionary, which dcc.Graph
+        takes as it is, built and saved next to the snapshot the first time it is asked for
+
+        Args:
+            name (str): the name of the tree
+            build (callable): called without arguments to make the plotly figure when it is not saved yet
+
+        Returns:
+            dict: the figure, None if it is nowhere and there is nothing to build it with
+        """
+        path = self.path(name, "figure")
+        entry = self.entries.get(name)
+        mtime = self.mtime(path)
+        if entry is not None and entry["figure"] is not None and entry["figure_mtime"] == mtime:
+            self.hits += 1
+            self.entries.move_to_end(name)
+            return entry["figure"]
+
+        self.misses += 1
+        if mtime is None:
+            if build is None:
+                return None
+            figure = build()
+            self.write(path, lambda figure_path: pio.write_json(figure, figure_path))
+            mtime = self.mtime(path)
+        with open(path) as f:
+            text = f.read()
+        figure = json.loads(text)
+        self.store(name, figure = figure, figure_mtime = mtime, figure_nbytes = len(text))
+        return figure
+
+    def invalidate(self, name):
+        """
+        Forgets the tree with this name and its figure, in memory and on disk
+
+        Args:
+            name (str): the name of the tree
+        """
+        self.entries.pop(name, None)
+        for kind in ("tree", "figure"):
+            try:
+                os.remove(self.path(name, kind))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Returns:
+            dict: the hits, misses, hit rate, number of entries and bytes of the cache in this process
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "nbytes": self.nbytes
+        }
+
+    def store(self, name, **values):
+    # Updates the in-memory entry of a name (as the most recently used one), then evicts down to the limits
+        entry = self.entries.pop(name, None) or {
+            "tree": None, "mtime": None, "figure": None, "figure_mtime": None, "tree_nbytes": 0, "figure_nbytes": 0
+        }
+        entry.update(values)
+        if "tree" in values:
+            entry["tree_nbytes"] = getattr(entry["tree"], "nbytes", 0)
+        entry["nbytes"] = entry["tree_nbytes"] + entry["figure_nbytes"]
+        self.entries[name] = entry
+    # The entry just used is never evicted, even when it is over max_bytes on its own
+        while len(self.entries) > 1 and (len(self.entries) > self.capacity or
+                                         (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            self.entries.popitem(last = False)
+
+    @staticmethod
+    def mtime(path):
+    # Modification time of a file in nanoseconds, None if it does not exist
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def write(path, save):
+    # Saves into a temporary file first and then moves it over the old one, so other processes never open half a file
+        handle, temporary = tempfile.mkstemp(dir = os.path.dirname(path), suffix = ".tmp")
+        os.close(handle)
+        try:
+            save(temporary)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise